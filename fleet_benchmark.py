@@ -0,0 +1,130 @@
+#!/usr/bin/env python2.7
+"""Benchmarks the monitor's check loop against simulated fleets, no MineOS or real servers needed
+
+Every run scales the monitor's timings down by --scale so a few seconds of wall time cover minutes of
+monitoring, then reports sweep time, how long crashes went unnoticed and how many restarts went through.
+"""
+
+import sys
+import logging
+import argparse
+from time import time
+
+import mineos_monitor
+from mineos_monitor import modes, restart_history, restart_queue, server_state, simulated_fleet
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class time_up(Exception):
+    """ Raised by the server source to take modes.monitor out of its loop once the run is over """
+
+
+def run(count, duration, workers, use_snapshot, args):
+    """ Runs modes.monitor against a fleet of count servers for duration seconds, returns the report row """
+    fleet = simulated_fleet(count, crash_rate=args.crash_rate, boot_time=args.boot_time,
+                            probe_latency=args.probe_latency, use_snapshot=use_snapshot)
+    monitor = modes(base_directory='/tmp', owner=None, sleep_delay=server_state.INTERVAL, workers=workers,
+                    backend=fleet)
+    checker = monitor.checker
+    sweeps = []
+    checks = [0]
+    end = time() + duration
+
+    def timed_sweep(server_list, sweep=checker.sweep):
+        start = time()
+        sweep(server_list)
+        sweeps.append(time() - start)
+        checks[0] += len(server_list)
+    checker.sweep = timed_sweep
+
+    def server_source():
+        if time() >= end:
+            raise time_up()
+        return fleet.list_servers(None)
+
+    try:
+        monitor.monitor(server_source)
+    except time_up:
+        pass
+    finally:
+        checker.pool.terminate()
+
+    detections = list(fleet.detections)
+    return (count, 'snapshot' if use_snapshot else 'per-server', len(sweeps), checks[0] / duration,
+            percentile(sweeps, 0.5), percentile(sweeps, 0.99), percentile(detections, 0.5),
+            percentile(detections, 0.99), len(fleet.starts) / duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the MineOS monitor against simulated fleets")
+    parser.add_argument("-s", "--sizes",
+                        action="store",
+                        type=int,
+                        nargs='+',
+                        default=[10, 100, 1000, 5000],
+                        help="Fleet sizes to run (ex. 10 100 1000)")
+    parser.add_argument("-d", "--duration",
+                        action="store",
+                        type=float,
+                        default=10,
+                        help="Seconds to watch each fleet for (ex. 10)")
+    parser.add_argument("-w", "--workers",
+                        action="store",
+                        type=int,
+                        default=8,
+                        help="Check workers (ex. 8)")
+    parser.add_argument("--scale",
+                        action="store",
+                        type=float,
+                        default=0.01,
+                        help="Factor applied to BOOT_WAIT and the check intervals (ex. 0.01)")
+    parser.add_argument("--crash_rate",
+                        action="store",
+                        type=float,
+                        default=0.01,
+                        help="Crashes per server per second (ex. 0.01)")
+    parser.add_argument("--boot_time",
+                        action="store",
+                        type=float,
+                        default=0.2,
+                        help="Seconds a simulated server takes to come up (ex. 0.2)")
+    parser.add_argument("--probe_latency",
+                        action="store",
+                        type=float,
+                        default=0.001,
+                        help="Seconds each per-server up check takes (ex. 0.001)")
+    parser.add_argument("--per_server",
+                        action="store_true",
+                        default=False,
+                        help="Also run every size with per-server up checks instead of one snapshot")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    mineos_monitor.BOOT_WAIT *= args.scale
+    server_state.INTERVAL *= args.scale
+    server_state.MIN_INTERVAL *= args.scale
+    server_state.MAX_INTERVAL *= args.scale
+    restart_history.CRASH_WINDOW *= args.scale
+    restart_history.HISTORY_FILE_PATH = None  # Keep the real restart_history.json out of it
+    restart_queue.MAX_LOAD = float('inf')  # The benchmark itself loads the host, don't let that hold restarts
+    restart_queue.MIN_FREE_MB = 0
+    mineos_monitor.STATUS_FILENAME = None  # Nor should -l on this host pick up the simulated servers
+
+    print("{0:>6} {1:>11} {2:>7} {3:>9} {4:>10} {5:>10} {6:>11} {7:>11} {8:>10}".format(
+        'Fleet', 'Liveness', 'Sweeps', 'Checks/s', 'Sweep p50', 'Sweep p99', 'Detect p50', 'Detect p99',
+        'Restarts/s'))
+    for count in args.sizes:
+        for use_snapshot in [True, False] if args.per_server else [True]:
+            print("{0:>6} {1:>11} {2:>7} {3:>9.0f} {4:>9.3f}s {5:>9.3f}s {6:>10.3f}s {7:>10.3f}s {8:>10.1f}".format(
+                *run(count, args.duration, args.workers, use_snapshot, args)))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,19 +4,41 @@
 
 import sys
 import os
+import re
 import json
+import socket
+import errno
+import struct
 import getpass
+import gzip
 import smtplib
 import logging
+import logging.handlers
+import Queue
+import atexit
+import heapq
+import array
+import random
+import select
 import argparse
-from time import sleep
+import threading
+import uuid
+import ctypes
+import ctypes.util
+import BaseHTTPServer
+from collections import deque
+from time import sleep, time, strftime, strptime, localtime, mktime
+from multiprocessing.pool import ThreadPool
 
 sys.path.append("/usr/games/minecraft")  # So we can run the script from other locations
 sys.path.append(os.getcwd() + '/keyring')  # Strange path issue, only appears when run from local console, not IDE
 
 import keyring
 from keyring.errors import PasswordDeleteError
-from mineos import mc
+try:
+    from mineos import mc
+except ImportError:  # Only needed for the real backend, --simulate runs without MineOS
+    mc = None
 
 __author__ = "Jesse S"
 __license__ = "GNU GPL v2.0"
@@ -26,10 +48,18 @@ __email__ = "jelloeater@gmail.com"
 
 BOOT_WAIT = 120
 LOG_FILENAME = "heartbeat.log"
+LOG_FORMAT = "[%(asctime)s] [%(levelname)8s] --- %(message)s (%(filename)s:%(lineno)s)"
+HUNG_RESTART_AFTER = 3  # Consecutive ping timeouts before a running but unresponsive server is restarted
+LAG_RESTART_AFTER = 5  # Consecutive slow RCON round trips before a lagging server is stopped for a restart
+SNAPSHOT_MAX_AGE = 1  # Seconds a /proc liveness snapshot is shared between checks
+SWEEP_TIMEOUT = 86400  # Upper bound for joining a sweep, keeps Ctrl-C working while we wait on the pool
+STATUS_FILENAME = "monitor_status.json"  # Every server's state and interval, written by a running monitor for -l
+STATUS_MAX_AGE = 10  # Seconds between writes of STATUS_FILENAME
 
 
 def main():
     """ Take arguments and direct program """
+    global STATUS_FILENAME  # Turned off by --simulate
     parser = argparse.ArgumentParser(description="A MineOS Server Monitor"
                                                  " (http://github.com/jelloeater/MineOSheartbeat)",
                                      version=__version__,
@@ -59,6 +89,16 @@ def main():
                              "--configure_email_alerts",
                              help="Configure email alerts",
                              action="store_true")
+    email_group.add_argument("--digest_window",
+                             action="store",
+                             type=int,
+                             default=60,
+                             help="Collect alerts for x seconds and send them as one e-mail, 0 sends each alone (ex. 60)")
+    email_group.add_argument("--max_alerts_per_hour",
+                             action="store",
+                             type=int,
+                             default=12,
+                             help="Most alert e-mails sent in any hour, extra alerts roll into the next one (ex. 12)")
     email_group.add_argument("-r",
                              "--remove_password_store",
                              help="Removes password stored in system keyring",
@@ -70,6 +110,113 @@ def main():
                         type=int,
                         default=60,
                         help="Wait x second between checks (ex. 60)")
+    parser.add_argument("--min_delay",
+                        action="store",
+                        type=int,
+                        default=15,
+                        help="Shortest per server check interval, used right after trouble (ex. 15)")
+    parser.add_argument("--max_delay",
+                        action="store",
+                        type=int,
+                        default=300,
+                        help="Longest per server check interval for long stable servers (ex. 300)")
+    parser.add_argument("-w",
+                        "--workers",
+                        action="store",
+                        type=int,
+                        default=4,
+                        help="Number of servers to check in parallel (ex. 4)")
+    parser.add_argument("--slp",
+                        action="store_true",
+                        help="Ping running servers (Server List Ping) and restart hung ones")
+    parser.add_argument("-q",
+                        "--query",
+                        action="store_true",
+                        help="Query every server with enable-query=true each sweep (players, MOTD, latency)")
+    parser.add_argument("--rcon",
+                        action="store_true",
+                        help="Time an RCON command on servers with enable-rcon=true to spot lag")
+    parser.add_argument("--tail_logs",
+                        action="store_true",
+                        help="Follow every server's logs/latest.log and crash-reports/ for crashes and lag warnings")
+    parser.add_argument("--lag_threshold",
+                        action="store",
+                        type=float,
+                        default=1.0,
+                        help="RCON round trip in seconds that counts as lagging (ex. 1.0)")
+    parser.add_argument("--probe_timeout",
+                        action="store",
+                        type=float,
+                        default=5,
+                        help="Seconds to wait on a server probe before calling it hung (ex. 5)")
+    parser.add_argument("-p",
+                        "--priority",
+                        action="append",
+                        default=[],
+                        metavar="SERVER=N",
+                        help="Check (and restart) this server ahead of lower priority ones, repeatable (ex. lobby=10)")
+    parser.add_argument("--max_boots",
+                        action="store",
+                        type=int,
+                        default=2,
+                        help="Most servers allowed to boot at the same time (ex. 2)")
+    parser.add_argument("--max_load",
+                        action="store",
+                        type=float,
+                        default=2.0,
+                        help="Hold further restarts while one boots and the 1 minute load average per CPU is above this (ex. 2.0)")
+    parser.add_argument("--min_free_mb",
+                        action="store",
+                        type=int,
+                        default=1024,
+                        help="Hold further restarts while one boots and less than this much memory is available (ex. 1024)")
+    parser.add_argument("--max_rss_mb",
+                        action="store",
+                        type=int,
+                        default=0,
+                        help="Restart a server ahead of time when its memory is predicted to reach this (ex. 6144)")
+    parser.add_argument("--leak_horizon",
+                        action="store",
+                        type=float,
+                        default=6,
+                        help="Hours ahead a predicted --max_rss_mb is acted on (ex. 6)")
+    parser.add_argument("--quiet_hours",
+                        action="store",
+                        default="4-6",
+                        help="Local hours a leaking server may be restarted in when query can't count players (ex. 4-6)")
+    parser.add_argument("--clear_quarantine",
+                        action="append",
+                        default=[],
+                        metavar="SERVER",
+                        help="Let a server that was quarantined for crash looping be restarted again, "
+                             "a monitor that is already running picks this up")
+    parser.add_argument("--metrics_port",
+                        action="store",
+                        type=int,
+                        default=0,
+                        help="Serve Prometheus metrics on this port at /metrics, 0 is off (ex. 9464)")
+    parser.add_argument("--statsd",
+                        action="store",
+                        metavar="HOST:PORT",
+                        help="Send metrics to a StatsD server once per sweep (ex. localhost:8125)")
+    parser.add_argument("--simulate",
+                        action="store",
+                        type=int,
+                        default=0,
+                        metavar="N",
+                        help="Watch a simulated fleet of N servers instead of MineOS, for trying settings out")
+    parser.add_argument("--poll_only",
+                        action="store_true",
+                        help="Don't watch server processes for exits, find crashes by polling alone")
+    parser.add_argument("--safety_delay",
+                        action="store",
+                        type=int,
+                        default=600,
+                        help="Seconds between safety net checks of servers whose process is watched (ex. 600)")
+    parser.add_argument("--engine",
+                        choices=['sweep', 'async'],
+                        default='sweep',
+                        help="sweep checks every server then sleeps, async gives each server its own timer")
     parser.add_argument('-b',
                         dest='base_directory',
                         default='/var/games/minecraft',
@@ -82,29 +229,83 @@ def main():
                         "--list",
                         action="store_true",
                         help="List MineOS Servers")
+    parser.add_argument("--log_max_mb",
+                        action="store",
+                        type=int,
+                        default=10,
+                        help="Rotate " + LOG_FILENAME + " once it reaches this size (ex. 10)")
+    parser.add_argument("--log_max_age",
+                        action="store",
+                        type=int,
+                        default=24 * 7,
+                        help="Rotate " + LOG_FILENAME + " after this many hours, 0 rotates by size only (ex. 168)")
+    parser.add_argument("--log_backups",
+                        action="store",
+                        type=int,
+                        default=5,
+                        help="Compressed rotated logs to keep (ex. 5)")
+    parser.add_argument("--log_json",
+                        action="store_true",
+                        help="Write " + LOG_FILENAME + " as one JSON object per line, including the per check records")
     parser.add_argument("--debug",
                         action="store_true",
                         help="Debug Mode Logging")
     args = parser.parse_args()
 
     if args.debug:
-        logging.basicConfig(format="[%(asctime)s] [%(levelname)8s] --- %(message)s (%(filename)s:%(lineno)s)",
+        logging.basicConfig(format=LOG_FORMAT,
                             level=logging.DEBUG)
+        if args.log_json:
+            logging.getLogger().handlers[0].setFormatter(json_log_formatter())
         logging.debug(sys.path)
         logging.debug(args)
         print("")
     else:
-        logging.basicConfig(filename=LOG_FILENAME,
-                            format="[%(asctime)s] [%(levelname)8s] --- %(message)s (%(filename)s:%(lineno)s)",
-                            level=logging.WARNING)
+        handler = rotating_log_handler(LOG_FILENAME,
+                                       max_bytes=args.log_max_mb * 1024 * 1024,
+                                       max_age=args.log_max_age * 3600,
+                                       backups=args.log_backups)
+        handler.setFormatter(json_log_formatter() if args.log_json else logging.Formatter(LOG_FORMAT))
+        logging.getLogger().addHandler(queue_log_handler(handler))  # Disk writes happen on a writer thread
+        logging.getLogger().setLevel(logging.INFO if args.log_json else logging.WARNING)  # Checks log at INFO
+
+    restart_queue.MAX_BOOTING = max(1, args.max_boots)
+    restart_queue.MAX_LOAD = args.max_load
+    restart_queue.MIN_FREE_MB = args.min_free_mb
+    resource_sampler.MAX_RSS = args.max_rss_mb * 1024 * 1024
+    resource_sampler.HORIZON = args.leak_horizon * 3600
+    try:
+        resource_sampler.QUIET_HOURS = tuple(int(i) for i in args.quiet_hours.split('-', 1))
+    except ValueError:
+        logging.error("Ignoring quiet hours %s, expected START-END", args.quiet_hours)
+    server_state.INTERVAL = args.delay
+    server_state.MIN_INTERVAL = min(args.min_delay, args.delay)
+    server_state.MAX_INTERVAL = max(args.max_delay, args.delay)
+    exit_watcher.ENABLED = not args.poll_only
+    exit_watcher.SAFETY_INTERVAL = max(args.safety_delay, server_state.MAX_INTERVAL)
+
+    if args.simulate:
+        backend = simulated_fleet(args.simulate)
+        restart_history.HISTORY_FILE_PATH = None  # Simulated restarts and quarantines stay out of the real files
+        STATUS_FILENAME = None
+    elif mc:
+        backend = mineos_backend()
+    else:
+        logging.critical("MineOS not found, expected it in /usr/games/minecraft")
+        sys.exit(1)
 
-    mode = modes(base_directory=args.base_directory, owner=args.owner, sleep_delay=args.delay)
+    mode = modes(base_directory=args.base_directory, owner=args.owner, sleep_delay=args.delay, workers=args.workers,
+                 engine=args.engine, priorities=parse_priorities(args.priority), backend=backend)
     # Create new mode object for flow, I'll buy that :)
 
     if len(sys.argv) == 1:  # Displays help and lists servers (to help first time users)
         parser.print_help()
         sys.exit(1)
 
+    for i in args.clear_quarantine:
+        mode.checker.restarts.history.clear(i)
+        print("Quarantine cleared for " + i)
+
     if args.list:
         mode.list_servers()
 
@@ -118,11 +319,38 @@ def main():
         print("E-mail notifications enabled")
         gmail().test_login()
         # Test email, this way the user knows immediately if there is a issue
+        server_logger.OUTBOX = alert_outbox(send=lambda subject, text: gmail().send(subject=subject, text=text))
+        server_logger.OUTBOX.start()  # Also picks up anything left over from a previous run
+        if args.digest_window > 0:
+            server_logger.DIGEST = alert_digest(outbox=server_logger.OUTBOX,
+                                                window=args.digest_window,
+                                                max_per_hour=args.max_alerts_per_hour)
+
+    if args.slp:
+        server_logger.USE_SLP = True
+    if args.query:
+        server_logger.USE_QUERY = True
+    if args.rcon:
+        server_logger.USE_RCON = True
+    if args.tail_logs:
+        server_logger.TAIL_LOGS = True
+    server_logger.LAG_THRESHOLD = args.lag_threshold
+    server_logger.PROBE_TIMEOUT = args.probe_timeout
 
     if args.email_mode and args.debug:
         logging.critical("Debug mode and e-mail notifications are mutually exclusive")
         sys.exit(1)
 
+    if args.metrics_port:
+        metrics_server(args.metrics_port).start()
+    if args.statsd:
+        host, _, port = args.statsd.rpartition(':')
+        try:
+            METRICS.sinks.append(statsd_emitter(host or 'localhost', int(port)))
+        except (socket.gaierror, ValueError) as e:
+            logging.critical("Can't use StatsD at %s: %s", args.statsd, e)
+            sys.exit(1)
+
     # Magic starts here
     if args.interactive:
         mode.interactive()
@@ -132,25 +360,106 @@ def main():
         mode.multi_server()
 
 
+def parse_priorities(values):
+    """ ['lobby=10', ...] -> {'lobby': 10} """
+    priorities = {}
+    for i in values:
+        try:
+            name, priority = i.rsplit('=', 1)
+            priorities[name] = int(priority)
+        except ValueError:
+            logging.error("Ignoring priority %s, expected SERVER=N", i)
+    return priorities
+
+
 class modes(object):  # Uses new style classes
-    def __init__(self, base_directory, owner, sleep_delay):
+    def __init__(self, base_directory, owner, sleep_delay, workers=1, engine='sweep', priorities=None, backend=None):
         self.base_directory = base_directory
         self.sleep_delay = sleep_delay
+        self.engine = engine
         self.owner = owner  # We NEED to specify owner or we get a error in the webGUI during start/stop from there
+        self.priorities = priorities or {}
+        self.backend = backend or mineos_backend()
+        self.checker = check_pool(base_directory=base_directory, owner=owner, workers=workers,
+                                  priorities=self.priorities, backend=self.backend)
+        self.inventory = server_inventory(self.backend, base_directory)
 
-    def sleep(self):
+    def sleep(self, seconds=None, inventory=None):
+        """ Sleeps, cut short when servers are added or removed or a watched server process exits """
         try:
-            sleep(self.sleep_delay)
+            seconds = self.sleep_delay if seconds is None else max(0, seconds)
+            waiting_on = [i for i in [inventory and inventory.fd, self.checker.exits.fileno()] if i is not None]
+            if inventory and inventory.fd is None:
+                seconds = min(seconds, server_inventory.RESCAN_INTERVAL)
+            if waiting_on:
+                select.select(waiting_on, [], [], seconds)
+            else:
+                sleep(seconds)
         except KeyboardInterrupt:
             print("Bye Bye.")
             sys.exit(0)
 
+    def sweep(self, server_list):
+        try:
+            self.checker.sweep(server_list)
+        except KeyboardInterrupt:
+            print("Bye Bye.")
+            sys.exit(0)
+
+    def monitor(self, server_source, inventory=None):
+        """ Runs the selected engine forever, server_source returns the names to watch
+
+        With an inventory, changes to the server list are picked up as they happen instead of once a delay.
+        """
+        if self.engine == 'async':
+            try:
+                event_loop(checker=self.checker, interval=self.sleep_delay,
+                           scheduler=check_scheduler(self.priorities), inventory=inventory).run(server_source)
+            except KeyboardInterrupt:
+                print("Bye Bye.")
+                sys.exit(0)
+            return
+
+        scheduler = check_scheduler(self.priorities)
+        query_at = 0
+        while True:
+            now = time()
+            server_list = server_source()
+            self.checker.sync(server_list)
+            scheduler.sync(server_list, now)
+            if server_logger.USE_QUERY and now >= query_at:  # Its own timer, a hung server costs a worker not the loop
+                query_at = now + self.sleep_delay
+                self.checker.pool.apply_async(self.checker.query_fleet, (server_list,))
+            for i in self.checker.exited():
+                scheduler.arm(i, now)
+            due = scheduler.pop_due(now)
+            if due:
+                self.sweep(due)
+                finished_at = time()
+                for i in due:  # A check that blew up never rescheduled itself, MIN_INTERVAL keeps it from spinning
+                    scheduler.arm(i, max(self.checker.states[i].next_check, finished_at + server_state.MIN_INTERVAL))
+            self.sleep(scheduler.next_deadline(default=now + self.sleep_delay) - time(), inventory)
+
     def list_servers(self):
+        """ Prints every server, with the state and check interval of the running monitor when there is one """
         print("Servers:")
-        print("{0}{1}".format("Name".ljust(20), 'State'))
-        for i in mc.list_servers(self.base_directory):
-            print "{0}{1}".format(i.ljust(20), ['down','up'][mc(i).up])
-        
+        print("{0}{1}{2}".format("Name".ljust(20), 'State'.ljust(10), 'Interval'))
+        snapshot = self.backend.snapshot(self.owner)
+        saved = {} if self.checker.states else check_pool.load_status()
+        for i in self.inventory.servers():
+            up = snapshot.up(i) if snapshot else self.backend.server(i, self.owner, self.base_directory).up
+            status = self.checker.states.get(i)
+            state, interval = (status.state, status.interval) if status else \
+                saved.get('servers', {}).get(i, (['down', 'up'][up], None))
+            if self.checker.restarts.history.is_quarantined(i):
+                state = server_state.QUARANTINED
+            print("{0}{1}{2}".format(i.ljust(20),
+                                     state.ljust(10),
+                                     "{0:.0f}s".format(interval) if interval else '-'))
+        if saved:
+            print("\nStates and intervals from the running monitor as of {0}".format(
+                strftime('%H:%M:%S', localtime(saved['taken']))))
+
     def interactive(self):
         servers_to_monitor = []
         print("Interactive Mode")
@@ -163,73 +472,2308 @@ class modes(object):  # Uses new style classes
 
             if server_name.lower() in ['done', 'd', ''] and servers_to_monitor:
                 break  # Only exits if we have work to do
-            elif server_name in mc.list_servers(self.base_directory):  # Checks if name is valid
+            elif server_name in self.inventory.servers():  # Checks if name is valid
                 servers_to_monitor.append(server_name)
 
         logging.info("Starting monitor")
-
-        while True:
-            for i in servers_to_monitor:
-                server_logger(server_name=i, owner=self.owner, base_directory=self.base_directory).check_server()
-            self.sleep()
+        self.monitor(lambda: servers_to_monitor)
 
     def multi_server(self):
         print("Multi Server mode")
         print("Press Ctrl-C to quit")
 
-        while True:
-            server_list = mc.list_servers(self.base_directory)
-            logging.debug(server_list)
-
-            for i in server_list:
-                server_logger(server_name=i, owner=self.owner, base_directory=self.base_directory).check_server()
-            self.sleep()
+        self.monitor(self.inventory.servers, inventory=self.inventory)
 
     def single_server(self, server_name):
         print("Single Server Mode: " + server_name)
         print("Press Ctrl-C to quit")
 
+        logging.debug(self.owner)
+        self.monitor(lambda: [server_name])
+
+
+class check_pool(object):
+    """ Bounded worker pool that fans server checks out and joins them every sweep """
+    def __init__(self, base_directory, owner, workers, priorities=None, backend=None, history=None):
+        self.base_directory = base_directory
+        self.owner = owner
+        self.backend = backend or mineos_backend()
+        self.workers = max(1, workers)
+        self.pool = ThreadPool(self.workers)
+        self.last_sweep_duration = 0.0
+        self.states = {}  # Server name -> server_state, kept between sweeps
+        self.listed = frozenset()  # Server names as of the last sync
+        self.status_saved = 0
+        self.exits = exit_watcher()
+        self.sampler = resource_sampler()
+        if resource_sampler.MAX_RSS:
+            self.sampler.start(self.snapshot)
+        self.liveness = None
+        self.liveness_lock = threading.Lock()
+        self.restarts = restart_queue(priorities, history or restart_history.loadHistory())
+
+    def record(self, server_name):
+        """ The long-lived server_state of a server, with its server_logger attached, only sync() adds them """
+        status = self.states.get(server_name)
+        if status is None:
+            status = self.states[server_name] = server_state(server_name)
+            status.monitor = server_logger(server_name=server_name,
+                                           owner=self.owner,
+                                           base_directory=self.base_directory,
+                                           backend=self.backend)
+        return status
+
+    def sync(self, server_list):
+        """ Adds records for new servers and drops removed ones, nothing is rebuilt while the list stays the same """
+        listed = frozenset(server_list)
+        if listed == self.listed:
+            return
+        for i in listed - self.listed:
+            self.record(i)
+        for i in self.listed - listed:
+            status = self.states.pop(i, None)
+            if status and status.rcon:
+                status.rcon.close()
+            if status and status.log:
+                status.log.close()
+            self.exits.unwatch(i)
+        logging.debug("Server list changed, %s added %s removed", len(listed - self.listed), len(self.listed - listed))
+        self.listed = listed
+
+    def admit_restarts(self):
+        """ Starts as many queued servers as the restart queue allows, on the pool so callers never block """
+        self.restarts.history.reloadClears()  # Cleared servers get restarted on their next check
+        now = time()
+        booting = sum(1 for i in self.states.values() if i.state == server_state.STARTING and now < i.deadline)
+        for server_name, reason, counted in self.restarts.admit(booting, self.states):
+            if counted:
+                self.restarts.history.record(server_name, now)
+            self.states[server_name].set(server_state.STARTING, deadline=now + BOOT_WAIT)
+            self.pool.apply_async(self.start, (server_name, reason))
+
+    def start(self, server_name, reason):
+        status = self.states.get(server_name)
+        if status is None:
+            return  # Removed while the start was waiting for a worker
+        try:
+            status.monitor.start_server(reason=reason)
+        except Exception:
+            logging.exception("Start failed for server %s", server_name)
+
+    def snapshot(self, refresh=False):
+        """ Shared /proc liveness snapshot, rescanned at most once every SNAPSHOT_MAX_AGE seconds """
+        with self.liveness_lock:
+            if refresh or not self.liveness or time() - self.liveness.taken > SNAPSHOT_MAX_AGE:
+                self.liveness = self.backend.snapshot(self.owner)
+                self.exits.sync(self.liveness, list(self.states))
+                self.sampler.sample(self.liveness, list(self.states))
+            return self.liveness
+
+    def exited(self):
+        """ Servers whose watched process exited since the last call, with the snapshot refreshed to match """
+        exited = self.exits.exited()
+        if exited:
+            self.snapshot(refresh=True)
+        return exited
+
+    def check(self, server_name):
+        status = self.states.get(server_name)
+        if status is None:
+            return  # Removed while the check was waiting for a worker, record() would bring it back for good
+        try:
+            status.monitor.check_server(status, self.snapshot(), self.restarts, self.sampler)
+            if status.state == server_state.UP and self.exits.watching(server_name) and not \
+                    (server_logger.USE_SLP or server_logger.USE_QUERY or server_logger.USE_RCON or
+                     server_logger.TAIL_LOGS or resource_sampler.MAX_RSS):
+                status.next_check = max(status.next_check, time() + exit_watcher.SAFETY_INTERVAL)  # Exit wakes us
+        except Exception:  # One broken server shouldn't take the rest of the sweep down with it
+            logging.exception("Check failed for server %s", server_name)
+
+    def query_fleet(self, server_list):
+        """ One batched query round for every running server with query enabled, picked up by check_server """
+        try:
+            targets = {}
+            for i in server_list:
+                status = self.states.get(i)
+                if status is None:
+                    continue  # Removed since the round was scheduled
+                properties = status.load_properties(status.monitor.properties_file)
+                if status.state == server_state.UP and properties.get('enable-query') == 'true':
+                    port = properties_port(i, properties, ['query.port', 'server-port'], 25565)
+                    if port is not None:
+                        targets[i] = (properties.get('server-ip') or '127.0.0.1', port)
+
+            results = query_prober(timeout=server_logger.PROBE_TIMEOUT).query(targets)
+            for i in targets:
+                status = self.states.get(i)
+                if status is not None:
+                    status.query = results.get(i)
+                    status.query_pending = True
+            logging.debug("Query round answered by %s/%s servers", len(results), len(targets))
+        except Exception:  # Runs on the pool, where nobody would see it otherwise
+            logging.exception("Query round failed")
+
+    def sweep(self, server_list):
+        start = time()
+        self.snapshot(refresh=True)  # One process table scan answers every check in this sweep
+        self.pool.map_async(self.check, server_list).get(SWEEP_TIMEOUT)  # get() w/o timeout swallows Ctrl-C
+        self.admit_restarts()
+        self.last_sweep_duration = time() - start
+        METRICS.observe('mineos_sweep_duration_seconds', self.last_sweep_duration)
+        METRICS.flush()
+        self.save_status()
+        logging.info("Sweep of %s servers with %s workers took %.3fs",
+                     len(server_list), self.workers, self.last_sweep_duration)
+
+
+    def save_status(self):
+        """ Writes STATUS_FILENAME at most every STATUS_MAX_AGE seconds, atomically like the restart history """
+        now = time()
+        if not STATUS_FILENAME or now - self.status_saved < STATUS_MAX_AGE:
+            return
+        self.status_saved = now
+        servers = dict((name, (i.state, i.interval)) for name, i in self.states.items())
+        try:
+            with open(STATUS_FILENAME + '.tmp', 'w') as fh:
+                fh.write(json.dumps({'taken': now, 'servers': servers}, sort_keys=True))
+            os.rename(STATUS_FILENAME + '.tmp', STATUS_FILENAME)
+        except (IOError, OSError) as e:
+            logging.error("Can't save monitor status: %s", e)
+
+    @staticmethod
+    def load_status():
+        """ What a running monitor last wrote to STATUS_FILENAME, {} when there is nothing recent """
+        try:
+            with open(STATUS_FILENAME) as fh:
+                saved = json.loads(fh.read())
+        except (IOError, ValueError, TypeError):
+            return {}
+        fresh = time() - saved.get('taken', 0) < max(STATUS_MAX_AGE, server_state.MAX_INTERVAL) * 2
+        return saved if fresh else {}
+
+
+class restart_history(object):
+    """ Recent restart times per server in small ring buffers, saved to disk so crash loops survive a monitor restart
+
+    CRASH_LOOP_RESTARTS restarts inside CRASH_WINDOW seconds is a crash loop, each further restart doubles
+    the backoff up to BACKOFF_CAP. QUARANTINE_AFTER restarts in the window stops restarts until cleared,
+    reloadClears() lets a running monitor see clears another process (--clear_quarantine) saved.
+    """
+    HISTORY_FILE_PATH = "restart_history.json"
+    HISTORY_LENGTH = 16
+    CRASH_WINDOW = 3600
+    CRASH_LOOP_RESTARTS = 3
+    QUARANTINE_AFTER = 6
+    BACKOFF_CAP = 3600
+
+    def __init__(self):
+        self.restarts = {}  # Server name -> deque of restart times
+        self.quarantined = set()
+        self.lock = threading.Lock()
+        self.saved = None  # (inode, mtime) of the file as we last read or wrote it
+
+    @classmethod
+    def saved_version(cls):
+        try:
+            stat = os.stat(cls.HISTORY_FILE_PATH)
+            return stat.st_ino, stat.st_mtime  # Every save renames a new file into place
+        except (OSError, TypeError):
+            return None
+
+    @classmethod
+    def loadHistory(cls):
+        history = cls()
+        if cls.HISTORY_FILE_PATH and os.path.isfile(cls.HISTORY_FILE_PATH):
+            try:
+                with open(cls.HISTORY_FILE_PATH) as fh:
+                    saved = json.loads(fh.read())
+                for name, times in saved.get('restarts', {}).items():
+                    history.restarts[name] = deque(times, maxlen=cls.HISTORY_LENGTH)
+                history.quarantined = set(saved.get('quarantined', []))
+            except (ValueError, AttributeError):
+                logging.error("Restart history has been corrupted, starting fresh")
+        history.saved = cls.saved_version()
+        logging.debug("Restart History Loaded")
+        return history
+
+    def saveHistory(self):
+        """ Caller holds the lock, a HISTORY_FILE_PATH of None keeps the history in memory only """
+        if not self.HISTORY_FILE_PATH:
+            return
+        saved = {'restarts': dict((name, list(times)) for name, times in self.restarts.items()),
+                 'quarantined': sorted(self.quarantined)}
+        try:
+            with open(self.HISTORY_FILE_PATH + '.tmp', "w") as fh:
+                fh.write(json.dumps(saved, sort_keys=True))
+            os.rename(self.HISTORY_FILE_PATH + '.tmp', self.HISTORY_FILE_PATH)  # Atomic, a crash can't leave half a file
+        except (IOError, OSError) as e:
+            logging.error("Can't save restart history: %s", e)
+        self.saved = self.saved_version()
+
+    def reloadClears(self):
+        """ Lifts quarantines that were cleared in the file by someone else since we last read or wrote it """
+        version = self.saved_version()
+        if version is None or version == self.saved:
+            return
+        with self.lock:
+            self.saved = version
+            try:
+                with open(self.HISTORY_FILE_PATH) as fh:
+                    quarantined = set(json.loads(fh.read()).get('quarantined', []))
+            except (IOError, ValueError, AttributeError):
+                return
+            for server_name in self.quarantined - quarantined:
+                logging.warning("Quarantine of server %s was cleared", server_name)
+                self.quarantined.discard(server_name)
+                self.restarts.pop(server_name, None)
+
+    def record(self, server_name, now):
+        with self.lock:
+            self.restarts.setdefault(server_name, deque(maxlen=self.HISTORY_LENGTH)).append(now)
+            self.saveHistory()
+
+    def recent(self, server_name, now):
+        return sum(1 for i in self.restarts.get(server_name, ()) if now - i < self.CRASH_WINDOW)
+
+    def backoff(self, server_name, now):
+        """ Seconds to hold off restarting a crash looping server, 0 when it isn't looping """
+        loops = self.recent(server_name, now) - self.CRASH_LOOP_RESTARTS
+        return 0 if loops < 0 else min(self.BACKOFF_CAP, BOOT_WAIT * 2 ** loops)
+
+    def is_quarantined(self, server_name):
+        return server_name in self.quarantined
+
+    def quarantine(self, server_name, now):
+        """ Quarantines the server if it has restarted too often, returns whether it is quarantined """
+        with self.lock:
+            if server_name not in self.quarantined and self.recent(server_name, now) >= self.QUARANTINE_AFTER:
+                self.quarantined.add(server_name)
+                self.saveHistory()
+            return server_name in self.quarantined
+
+    def clear(self, server_name):
+        with self.lock:
+            self.quarantined.discard(server_name)
+            self.restarts.pop(server_name, None)
+            self.saveHistory()
+
+
+class restart_queue(object):
+    """ Restart requests waiting for a boot slot, so a mass outage doesn't turn into a mass JVM start
+
+    Highest priority first, then oldest. Nothing is admitted while MAX_BOOTING servers are still
+    in their boot window, or while the host is short on CPU or memory according to /proc and another
+    server is booting. With nothing booting one restart always goes through, so a busy host can't hold
+    crashed servers down for good.
+    """
+    MAX_BOOTING = 2
+    MAX_LOAD = 2.0  # 1 minute load average per CPU
+    MIN_FREE_MB = 1024
+
+    def __init__(self, priorities=None, history=None):
+        self.priorities = priorities or {}
+        self.history = history or restart_history()
+        self.heap = []  # (-priority, requested at, server_name, reason, counted)
+        self.queued = set()
+        self.lock = threading.Lock()  # Requests come in from check threads
+        self.holding = False  # Warned about the current hold already
+
+    def __len__(self):
+        return len(self.queued)
+
+    def request(self, server_name, reason, counted=True):
+        """ Queues a restart, counted ones go into the restart history once admitted """
+        with self.lock:
+            if server_name not in self.queued:
+                self.queued.add(server_name)
+                heapq.heappush(self.heap, (-self.priorities.get(server_name, 0), time(), server_name, reason, counted))
+                logging.info("Server %s queued for restart (%s waiting)", server_name, len(self.queued))
+
+    @staticmethod
+    def host_headroom():
+        """ (load average per CPU, available MB), either is None when /proc can't tell us """
+        load, free_mb = None, None
+        try:
+            with open('/proc/loadavg') as f:
+                load = float(f.read().split()[0]) / max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+        except (IOError, OSError, ValueError):
+            pass
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        free_mb = int(line.split()[1]) / 1024
+                        break
+        except (IOError, OSError, ValueError):
+            pass
+        return load, free_mb
+
+    def admit(self, booting, states):
+        """ Pops the (server_name, reason, counted) requests allowed to start now, skipping servers back on their own """
+        admitted = []
+        with self.lock:
+            while self.heap and booting + len(admitted) < restart_queue.MAX_BOOTING:
+                load, free_mb = self.host_headroom() if booting + len(admitted) else (None, None)
+                if (load is not None and load > restart_queue.MAX_LOAD) or \
+                        (free_mb is not None and free_mb < restart_queue.MIN_FREE_MB):
+                    if not self.holding:
+                        logging.warning("Holding %s restarts until a booting server settles, load %s available %sMB",
+                                        len(self.queued), load, free_mb)
+                    self.holding = True
+                    break
+                self.holding = False
+                _, _, server_name, reason, counted = heapq.heappop(self.heap)
+                self.queued.discard(server_name)
+                if server_name in states and states[server_name].state == server_state.QUEUED:
+                    admitted.append((server_name, reason, counted))
+        return admitted
+
+
+class metrics_registry(object):
+    """ Counters, gauges and histograms kept pre-aggregated in memory, rendered in Prometheus text format
+
+    Updates do the aggregation, a scrape only renders, and the rendered text is reused until something changes.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    HELP = {'mineos_server_up': ('gauge', "1 if the server is up, 0 otherwise"),
+            'mineos_server_check_interval_seconds': ('gauge', "Current adaptive check interval"),
+            'mineos_probe_latency_seconds': ('histogram', "Probe round trip by probe type"),
+            'mineos_restarts_total': ('counter', "Servers started by the monitor"),
+            'mineos_log_events_total': ('counter', "Crash and lag signatures found in server logs"),
+            'mineos_server_rss_bytes': ('gauge', "Resident memory of the server process"),
+            'mineos_server_cpu_seconds': ('gauge', "CPU time used by the server process so far"),
+            'mineos_server_threads': ('gauge', "Threads in the server process"),
+            'mineos_server_memory_eta_seconds': ('gauge', "Predicted time until the server reaches --max_rss_mb"),
+            'mineos_sweep_duration_seconds': ('histogram', "Time taken by a sweep over the due servers"),
+            'mineos_alert_queue_depth': ('gauge', "Alerts spooled and waiting for delivery"),
+            'mineos_smtp_seconds': ('histogram', "SMTP handshake and send time")}
+
+    def __init__(self):
+        self.values = {}  # name -> {labels: value, or [bucket counts, sum, count] for histograms}
+        self.lock = threading.Lock()
+        self.version = 0
+        self.rendered = (-1, '')
+        self.sinks = []  # Push emitters that also get every update, see statsd_emitter
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+            self.version += 1
+        for sink in self.sinks:
+            sink.record(name, value, 'g', labels)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + value
+            self.version += 1
+        for sink in self.sinks:
+            sink.record(name, value, 'c', labels)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            if key not in series:
+                series[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            histogram = series[key]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+            self.version += 1
+        for sink in self.sinks:
+            sink.record(name, value * 1000, 'ms', labels)  # Histograms are all in seconds, StatsD timers are ms
+
+    @staticmethod
+    def labels(pairs):
+        if not pairs:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in pairs) + '}'
+
+    def render(self):
+        with self.lock:
+            if self.rendered[0] == self.version:
+                return self.rendered[1]
+            lines = []
+            for name in sorted(self.values):
+                kind, text = self.HELP.get(name, ('untyped', name))
+                lines.append('# HELP {0} {1}'.format(name, text))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for key, value in sorted(self.values[name].items()):
+                    if kind != 'histogram':
+                        lines.append('{0}{1} {2}'.format(name, self.labels(key), value))
+                        continue
+                    buckets, total, count = value
+                    cumulative = 0
+                    for bound, hits in zip(self.BUCKETS, buckets):
+                        cumulative += hits
+                        lines.append('{0}_bucket{1} {2}'.format(name, self.labels(key + (('le', bound),)), cumulative))
+                    lines.append('{0}_bucket{1} {2}'.format(name, self.labels(key + (('le', '+Inf'),)), count))
+                    lines.append('{0}_sum{1} {2}'.format(name, self.labels(key), total))
+                    lines.append('{0}_count{1} {2}'.format(name, self.labels(key), count))
+            self.rendered = (self.version, '\n'.join(lines) + '\n')
+            return self.rendered[1]
+
+
+METRICS = metrics_registry()
+
+
+class statsd_emitter(object):
+    """ Buffers metric updates as StatsD lines and sends them in packet sized batches on flush()
+
+    The socket is non-blocking and anything that can't be sent straight away is dropped, metrics
+    must never hold up a check. Label values become dotted name parts, mineos.server_up.lobby:1|g.
+    """
+    MAX_PACKET = 1432  # Fits a 1500 byte MTU once IP and UDP headers are added
+    MAX_BUFFERED = 10000  # Oldest lines are dropped past this if nothing flushes
+
+    def __init__(self, host, port, prefix='mineos'):
+        family, _, _, _, self.address = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]  # Once, not per send
+        self.prefix = prefix
+        self.buffer = deque(maxlen=self.MAX_BUFFERED)  # deque appends are thread safe, no lock needed
+        self.dropped = 0
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+
+    @staticmethod
+    def clean(part):
+        return re.sub(r'[^\w\-]', '_', str(part))
+
+    def record(self, name, value, kind, labels):
+        name = name[len('mineos_'):] if name.startswith('mineos_') else name
+        parts = [self.prefix, name] + [self.clean(labels[i]) for i in sorted(labels)]
+        value = int(value) if kind == 'c' else repr(float(value))  # {:g} would cut an RSS gauge to 6 digits
+        self.buffer.append('{0}:{1}|{2}'.format('.'.join(parts), value, kind))
+
+    def packets(self):
+        packet = ''
+        while self.buffer:
+            line = self.buffer.popleft()
+            if packet and len(packet) + 1 + len(line) > self.MAX_PACKET:
+                yield packet
+                packet = ''
+            packet = packet + '\n' + line if packet else line
+        if packet:
+            yield packet
+
+    def flush(self):
+        for packet in self.packets():
+            try:
+                self.sock.sendto(packet.encode('utf-8'), self.address)
+            except socket.error:  # Full buffer, no route, nobody listening... metrics are best effort
+                self.dropped += 1
+
+
+class metrics_server(object):
+    """ Serves METRICS at /metrics from a background thread """
+    def __init__(self, port, host=''):
+        class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = METRICS.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # Scrapes every 15s would drown the log
+
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), handler)
+
+    def start(self):
+        worker = threading.Thread(target=self.httpd.serve_forever, name="metrics")
+        worker.daemon = True
+        worker.start()
+        return self
+
+
+class server_inventory(object):
+    """ The server list, only re-listed when the MineOS servers directory changes
+
+    inotify on the directory wakes waiters the moment a server is added or removed. Where inotify isn't
+    available the directory mtime is checked at most every RESCAN_INTERVAL seconds instead.
+    """
+    RESCAN_INTERVAL = 1
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+    def __init__(self, backend, base_directory):
+        self.backend = backend
+        self.base_directory = base_directory
+        self.directory = os.path.join(base_directory, 'servers')
+        self.fd = self.watch(self.directory)
+        self.mtime = self.directory_mtime()
+        self.checked = time()
+        self.server_list = backend.list_servers(base_directory)
+
+    @classmethod
+    def watch(cls, directory):
+        """ Non-blocking inotify descriptor watching directory for entries coming and going, None if we can't """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        mask = cls.IN_CREATE | cls.IN_DELETE | cls.IN_MOVED_FROM | cls.IN_MOVED_TO | cls.IN_DELETE_SELF | cls.IN_MOVE_SELF
+        if libc.inotify_add_watch(fd, directory.encode('utf-8'), mask) < 0:
+            logging.debug("Can't watch %s (%s), rescanning on mtime", directory, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+        return fd
+
+    def directory_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime
+        except OSError:
+            return None  # Nothing to go by, so every check rescans
+
+    def changed(self):
+        """ Whether the directory may have changed since the last call, drains pending inotify events """
+        if self.fd is not None:
+            events = 0
+            while True:
+                try:
+                    data = os.read(self.fd, 65536)
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        break
+                    raise
+                offset = 0
+                while offset < len(data):
+                    _, mask, _, length = self.EVENT.unpack_from(data, offset)
+                    offset += self.EVENT.size + length
+                    events += 1
+                    if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                        logging.warning("%s went away, rescanning on mtime from now on", self.directory)
+                        os.close(self.fd)
+                        self.fd = None
+                        return True
+            return events > 0
+
+        now = time()
+        if now - self.checked < server_inventory.RESCAN_INTERVAL:
+            return False
+        self.checked = now
+        mtime = self.directory_mtime()
+        if mtime is not None and mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        return True
+
+    def refresh(self):
+        """ Re-lists the servers if the directory changed, returns whether the list did """
+        if not self.changed():
+            return False
+        server_list = self.backend.list_servers(self.base_directory)
+        if sorted(server_list) == sorted(self.server_list):
+            return False
+        logging.info("Server list changed: %s", ', '.join(server_list))
+        self.server_list = server_list
+        return True
+
+    def servers(self):
+        self.refresh()
+        return self.server_list
+
+
+class exit_watcher(object):
+    """ A pidfd for every running server process in one epoll set, so a crash is seen the moment the JVM exits
+
+    pidfd_open needs Linux 5.3 and has no Python 2 binding, so it is called by syscall number. Without it
+    servers are just polled. Watched servers that aren't probed are only polled every SAFETY_INTERVAL seconds.
+    """
+    ENABLED = True
+    SAFETY_INTERVAL = 600
+    PIDFD_OPEN = 434  # Architectures on the shared syscall table: x86, arm, arm64, powerpc, s390, riscv...
+    PIDFD_OPEN_BY_MACHINE = {'alpha': 544, 'ia64': 1458}  # ...and the ones with their own numbering
+    NO_PIDFD_MACHINES = ('mips',)  # Number depends on the ABI, which uname can't tell us
+
+    def __init__(self):
+        self.watched = {}  # Server name -> (pid, pidfd)
+        self.names = {}  # pidfd -> server name
+        self.lock = threading.RLock()  # Snapshots are refreshed from check threads, unwatch() nests in sync()
+        self.epoll = None
+        machine = os.uname()[4]
+        self.syscall = exit_watcher.PIDFD_OPEN_BY_MACHINE.get(machine, exit_watcher.PIDFD_OPEN)
+        if not exit_watcher.ENABLED or machine.startswith(exit_watcher.NO_PIDFD_MACHINES):
+            return
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self.pidfd_open(os.getpid())
+        except (OSError, AttributeError):
+            fd = None
+        if fd is None:
+            logging.info("Process exit notifications unavailable, polling only")
+            return
+        os.close(fd)
+        self.epoll = select.epoll()
+
+    def pidfd_open(self, pid):
+        fd = self.libc.syscall(self.syscall, ctypes.c_int(pid), ctypes.c_uint(0))
+        return fd if fd >= 0 else None
+
+    def fileno(self):
+        return self.epoll.fileno() if self.epoll else None
+
+    def watching(self, server_name):
+        return server_name in self.watched
+
+    def sync(self, snapshot, server_list):
+        """ Watches the current process of every listed server, follows restarts and forgets removed servers """
+        if not self.epoll or not snapshot:
+            return
+        with self.lock:
+            for server_name in server_list:
+                pid = snapshot.pid(server_name)
+                if pid == self.watched.get(server_name, (None, None))[0]:
+                    continue
+                self.unwatch(server_name)
+                fd = self.pidfd_open(pid) if pid else None
+                if fd is not None:
+                    self.watched[server_name] = (pid, fd)
+                    self.names[fd] = server_name
+                    self.epoll.register(fd, select.EPOLLIN)
+            for server_name in set(self.watched) - set(server_list):
+                self.unwatch(server_name)
+
+    def unwatch(self, server_name):
+        with self.lock:
+            _, fd = self.watched.pop(server_name, (None, None))
+            if fd is not None:
+                del self.names[fd]
+                self.epoll.unregister(fd)
+                os.close(fd)
+
+    def exited(self):
+        """ Names of the servers whose process exited, each reported once """
+        if not self.epoll:
+            return []
+        exited = []
+        with self.lock:
+            for fd, _ in self.epoll.poll(0):
+                server_name = self.names.get(fd)
+                if server_name:
+                    logging.warning("Server %s process %s exited", server_name, self.watched[server_name][0])
+                    self.unwatch(server_name)
+                    exited.append(server_name)
+        return exited
+
+
+class check_scheduler(object):
+    """ Heap of per server deadlines, so a loop can sleep exactly until the next server is due
+
+    Servers are popped when due and re-armed with their next deadline once their check finishes,
+    ties go to the higher priority. Cancelled heap entries are just flagged dead and skipped.
+    """
+    JITTER = 0.1  # Deadlines are spread by up to +/- this fraction of the interval
+
+    def __init__(self, priorities=None):
+        self.priorities = priorities or {}
+        self.heap = []  # [due, -priority, server_name, alive]
+        self.entries = {}  # Armed server name -> its heap entry
+        self.servers = set()
+
+    def sync(self, server_list, now):
+        """ Arms new servers, spread over the first jitter window, and forgets removed ones """
+        server_list = set(server_list)
+        new, removed = server_list - self.servers, self.servers - server_list
+        self.servers = server_list
+        for i in removed:
+            self.disarm(i)
+        for i in new:
+            self.arm(i, now + random.uniform(0, check_scheduler.JITTER * server_state.INTERVAL))
+
+    def arm(self, server_name, due):
+        if server_name not in self.servers:
+            return
+        self.disarm(server_name)
+        entry = [due, -self.priorities.get(server_name, 0), server_name, True]
+        self.entries[server_name] = entry
+        heapq.heappush(self.heap, entry)
+
+    def disarm(self, server_name):
+        entry = self.entries.pop(server_name, None)
+        if entry:
+            entry[-1] = False
+
+    def pop_due(self, now):
+        """ Removes and returns every server due by now, highest priority first """
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if entry[-1]:
+                del self.entries[entry[2]]
+                due.append(entry)
+        return [entry[2] for entry in sorted(due, key=lambda entry: entry[1])]
+
+    def next_deadline(self, default):
+        while self.heap and not self.heap[0][-1]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else default
+
+
+class event_loop(object):
+    """ Timer driven engine, every server has its own deadline and blocking checks run on the check pool
+
+    The loop thread only ever blocks in select(), on a wake-up pipe the pool writes to when a check finishes,
+    so it idles at zero CPU and wakes exactly when the next server is due.
+    """
+    def __init__(self, checker, interval, scheduler, inventory=None):
+        self.checker = checker
+        self.interval = interval  # How often metrics are flushed and the server list refreshed without an inventory
+        self.scheduler = scheduler
+        self.inventory = inventory
+        self.finished = deque()  # Filled by pool threads, drained by the loop
+        self.recheck = set()  # Servers whose process exited while their check was running
+        self.wake_r, self.wake_w = os.pipe()
+
+    def done(self, server_name):
+        self.finished.append((time(), server_name))
+        os.write(self.wake_w, b'x')
+
+    def dispatch(self, server_name):
+        self.checker.pool.apply_async(self.checker.check, (server_name,),
+                                      callback=lambda _: self.done(server_name))
+
+    def run(self, server_source):
+        refresh_at = 0
+        while True:
+            now = time()
+            listed = self.inventory and self.inventory.refresh()
+            if listed or now >= refresh_at:
+                server_list = server_source()
+                self.checker.sync(server_list)
+                self.scheduler.sync(server_list, now)
+            if now >= refresh_at:
+                refresh_at = now + self.interval
+                METRICS.flush()
+                self.checker.save_status()
+                if server_logger.USE_QUERY:
+                    self.checker.pool.apply_async(self.checker.query_fleet, (list(self.scheduler.servers),))
+
+            for server_name in self.scheduler.pop_due(now):
+                self.dispatch(server_name)  # Re-armed once the check finishes, so checks never overlap
+
+            next_due = min(refresh_at, self.scheduler.next_deadline(default=refresh_at))
+            waiting_on = [self.wake_r]
+            if self.checker.exits.fileno() is not None:
+                waiting_on.append(self.checker.exits.fileno())
+            if self.inventory and self.inventory.fd is not None:
+                waiting_on.append(self.inventory.fd)  # Drained by refresh() on the next pass
+            elif self.inventory:
+                next_due = min(next_due, time() + server_inventory.RESCAN_INTERVAL)
+            readable, _, _ = select.select(waiting_on, [], [], max(0, next_due - time()))
+            if self.wake_r in readable:
+                os.read(self.wake_r, 4096)
+            for server_name in self.checker.exited():
+                if server_name in self.scheduler.entries:
+                    self.scheduler.disarm(server_name)
+                    self.dispatch(server_name)
+                elif server_name in self.scheduler.servers:
+                    self.recheck.add(server_name)  # Already being checked, go again as soon as that finishes
+            while self.finished:
+                finished_at, server_name = self.finished.popleft()
+                if server_name in self.recheck:
+                    self.recheck.discard(server_name)
+                    self.scheduler.arm(server_name, finished_at)
+                    continue
+                status = self.checker.states.get(server_name)
+                if status:  # Gone if the server was removed while its check ran
+                    self.scheduler.arm(server_name, max(status.next_check, finished_at + server_state.MIN_INTERVAL))
+            self.checker.admit_restarts()
+
+
+class liveness_snapshot(object):
+    """ Server name -> (screen pid, java pid) index built from a single pass over /proc
+
+    MineOS runs every server inside 'screen -dmS mc-<name>' with the JVM as a child of the screen process.
+    The screen socket directory is read as well, so servers are still seen when /proc cmdlines are hidden.
+    """
+    SCREEN_PATTERN = re.compile(r'^\S*screen\s.*?\bmc-([\w.\-]+)', re.IGNORECASE)
+    SOCKET_PATTERN = re.compile(r'^(\d+)\.mc-([\w.\-]+)$')
+
+    def __init__(self):
+        self.taken = time()
+        self.processes = {}
+
+    def up(self, server_name):
+        return server_name in self.processes
+
+    def pid(self, server_name):
+        """ Java PID if we found it, otherwise the screen PID """
+        screen_pid, java_pid = self.processes.get(server_name, (None, None))
+        return java_pid or screen_pid
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):  # Processes come and go while we scan
+            return b''
+
+    @classmethod
+    def scan(cls, owner):
+        """ Returns a new snapshot, or None when there is no /proc to read """
+        if not os.path.isdir('/proc'):
+            return None
+        snapshot = cls()
+        screens = {}  # Screen pid -> server name
+        java = []
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            cmdline = cls.read('/proc/{0}/cmdline'.format(pid)).replace(b'\0', b' ').decode('utf-8', 'replace')
+            match = cls.SCREEN_PATTERN.match(cmdline)
+            if match:
+                screens[int(pid)] = match.group(1)
+            elif 'java' in cmdline:
+                java.append(int(pid))
+
+        for screen_dir in [os.environ.get('SCREENDIR'), '/var/run/screen/S-' + owner, '/run/screen/S-' + owner]:
+            if screen_dir and os.path.isdir(screen_dir):
+                for i in os.listdir(screen_dir):
+                    match = cls.SOCKET_PATTERN.match(i)
+                    if match and os.path.isdir('/proc/' + match.group(1)):
+                        screens.setdefault(int(match.group(1)), match.group(2))
+                break
+
+        for screen_pid, server_name in screens.items():
+            snapshot.processes[server_name] = (screen_pid, None)
+        for pid in java:
+            stat = cls.read('/proc/{0}/stat'.format(pid))
+            try:
+                ppid = int(stat[stat.rindex(b')') + 2:].split()[1])  # Name field can contain spaces
+            except ValueError:
+                continue
+            if ppid in screens:
+                snapshot.processes[screens[ppid]] = (ppid, pid)
+        return snapshot
+
+
+class server_state(object):
+    """ Where a server is in its restart cycle, kept between sweeps so we never block waiting on a boot """
+    UP = 'up'
+    DOWN = 'down'
+    STARTING = 'starting'  # Restarted, skipped until the boot deadline passes
+    BACKOFF = 'backoff'  # Didn't come up in time, left alone until the retry deadline passes
+    QUEUED = 'queued'  # Down and waiting in the restart queue for a boot slot
+    QUARANTINED = 'quarantined'  # Crash looping, left alone until cleared with --clear_quarantine
+
+    INTERVAL = 60  # Starting check interval, stretched towards MAX_INTERVAL while a server stays healthy
+    MIN_INTERVAL = 15
+    MAX_INTERVAL = 300
+    STABLE_AFTER = 3  # Healthy checks in a row before the interval starts to stretch
+    GROWTH = 1.5
+
+    __slots__ = ('server_name', 'monitor', 'state', 'deadline', 'interval', 'stable', 'next_check', 'hung', 'latency',
+                 'query', 'query_pending', 'rcon', 'lag', 'laggy', 'stopped_for', 'proactive', 'properties',
+                 'properties_mtime', 'log', 'crashed', 'behind')
+
+    def __init__(self, server_name):
+        self.server_name = server_name
+        self.monitor = None  # server_logger, built once per server by check_pool.record
+        self.state = server_state.UP
+        self.deadline = 0  # Boot deadline while STARTING, retry time while BACKOFF
+        self.interval = server_state.INTERVAL
+        self.stable = 0  # Healthy checks in a row
+        self.next_check = 0
+        self.hung = 0  # Consecutive probe timeouts
+        self.latency = None  # Last probe round trip in seconds
+        self.query = None  # Last query reply, None when the server didn't answer
+        self.query_pending = False  # Set by a query round, cleared once check_server has looked at it
+        self.rcon = None  # rcon_session kept open between sweeps
+        self.lag = None  # Last RCON round trip in seconds
+        self.laggy = 0  # Consecutive round trips over the lag threshold
+        self.stopped_for = None  # Why we stopped the server ourselves, used as the restart reason
+        self.proactive = False  # Stopped ahead of trouble, the restart doesn't count towards crash loops
+        self.properties = {}
+        self.properties_mtime = 0
+        self.log = None  # log_tail, made on the first check with --tail_logs
+        self.crashed = None  # (seen at, crash line or report) from the logs, used as the restart reason
+        self.behind = 0  # Milliseconds behind in the last "Can't keep up!" warning since the previous check
+
+    def load_properties(self, path):
+        """ server.properties as a dict, only re-read when the file changes """
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime != self.properties_mtime:
+                with open(path) as f:
+                    self.properties = dict(line.strip().split('=', 1) for line in f
+                                           if '=' in line and not line.startswith('#'))
+                self.properties_mtime = mtime
+        except (IOError, OSError):
+            logging.warning("Can't read %s", path)
+        return self.properties
+
+    def waiting(self, now):
+        return self.state in (server_state.STARTING, server_state.BACKOFF) and now < self.deadline
+
+    def adapt(self, healthy):
+        """ Stretches the interval of stable servers, snaps it back to the minimum on any trouble """
+        if healthy:
+            self.stable += 1
+            if self.stable > server_state.STABLE_AFTER:
+                self.interval = min(server_state.MAX_INTERVAL, self.interval * server_state.GROWTH)
+        else:
+            self.stable = 0
+            self.interval = server_state.MIN_INTERVAL
+
+    def schedule(self, now):
+        jitter = random.uniform(-check_scheduler.JITTER, check_scheduler.JITTER)
+        self.next_check = max(now + self.interval * (1 + jitter), self.deadline)
+
+    def set(self, state, deadline=0):
+        if state != self.state:
+            logging.info("Server %s %s -> %s", self.server_name, self.state, state)
+        self.state = state
+        self.deadline = deadline
+
+
+def properties_path(base_directory, server_name):
+    return os.path.join(base_directory, 'servers', server_name, 'server.properties')
+
+
+def properties_port(server_name, properties, keys, default):
+    """ The first of keys set in server.properties as a port, None with a warning when it isn't a number """
+    value = next((properties[i] for i in keys if properties.get(i)), default)
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning("Server %s has a bad %s in server.properties: %r", server_name, ' or '.join(keys), value)
+        return None
+
+
+class log_tail(object):
+    """ Follows a server's logs/latest.log by byte offset and inode, and notices new files in crash-reports/
+
+    Only bytes appended since the last read are read. When the log is rotated the rest of the old file is
+    drained through the descriptor we still hold before the new one is opened, so no lines are lost.
+    """
+    CRASH_PATTERN = re.compile(br'---- Minecraft Crash Report ----|#@!@# Game crashed!|Exception in server tick loop|'
+                               br'Encountered an unexpected exception|java\.lang\.OutOfMemoryError|'
+                               br'This crash report has been saved to')
+    LAG_PATTERN = re.compile(br"Can't keep up!.*?Running (\d+)ms")
+    READ_MAX = 1024 * 1024  # Anything further behind than this is skipped rather than read
+    REASON_AGE = 600  # Seconds a logged crash stays the reason for a restart
+
+    __slots__ = ('log_file', 'crash_directory', 'fd', 'inode', 'partial', 'reports', 'reports_mtime')
+
+    def __init__(self, base_directory, server_name):
+        server_directory = os.path.join(base_directory, 'servers', server_name)
+        self.log_file = os.path.join(server_directory, 'logs', 'latest.log')
+        self.crash_directory = os.path.join(server_directory, 'crash-reports')
+        self.fd = None
+        self.inode = None
+        self.partial = b''  # Unterminated last line, finished by the next read
+        self.reports = None  # Crash report names already seen, None until the first look
+        self.reports_mtime = None
+
+    def open(self, at_end):
+        try:
+            self.fd = os.open(self.log_file, os.O_RDONLY)
+        except OSError:
+            self.inode = self.inode or 0  # A log that shows up later is read from its start
+            return False
+        self.inode = os.fstat(self.fd).st_ino
+        if at_end:  # Only what is written from now on, not the history from before we started
+            os.lseek(self.fd, 0, os.SEEK_END)
+        return True
+
+    def read(self):
+        """ Appended bytes from the open descriptor, skipping ahead if we are more than READ_MAX behind """
+        offset = os.lseek(self.fd, 0, os.SEEK_CUR)
+        size = os.fstat(self.fd).st_size
+        if size < offset:  # Truncated in place
+            offset = os.lseek(self.fd, 0, os.SEEK_SET)
+            self.partial = b''
+        if size - offset > log_tail.READ_MAX:
+            logging.warning("Skipping %s bytes of %s", size - offset - log_tail.READ_MAX, self.log_file)
+            os.lseek(self.fd, size - log_tail.READ_MAX, os.SEEK_SET)
+            self.partial = b''
+        chunks = []
         while True:
-            logging.debug(self.owner)
-            server_logger(server_name=server_name, owner=self.owner, base_directory=self.base_directory).check_server()
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def lines(self):
+        """ Complete lines appended since the last call """
+        if self.fd is None and not self.open(at_end=self.inode is None):
+            return []
+        data = self.read()
+        data, self.partial = self.partial + data, b''
+        try:
+            rotated = os.stat(self.log_file).st_ino != self.inode
+        except OSError:
+            rotated = True
+        if rotated:  # What was left in the old file is already in data, carry on in the new one from the start
+            os.close(self.fd)
+            self.fd = None
+            if data:
+                data += b'\n'
+            if self.open(at_end=False):
+                data += self.read()
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        return lines
+
+    def crash_reports(self):
+        """ Crash reports written since the last call, the directory is only listed when its mtime changes """
+        try:
+            mtime = os.stat(self.crash_directory).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.reports_mtime and self.reports is not None:
+            return []
+        self.reports_mtime = mtime
+        reports = set(os.listdir(self.crash_directory)) if mtime is not None else set()
+        new = [] if self.reports is None else sorted(reports - self.reports)
+        self.reports = reports
+        return new
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class resource_history(object):
+    """ Last LENGTH samples of one server process in ring buffers, arrays of doubles rather than lists of objects """
+    LENGTH = 120
+
+    __slots__ = ('pid', 'seen', 'times', 'rss', 'cpu', 'threads', 'count', 'next')
+
+    def __init__(self, pid, seen):
+        self.pid = pid
+        self.seen = seen  # When we first saw the process
+        self.times = array.array('d', [0.0]) * resource_history.LENGTH
+        self.rss = array.array('d', [0.0]) * resource_history.LENGTH
+        self.cpu = array.array('d', [0.0]) * resource_history.LENGTH
+        self.threads = array.array('d', [0.0]) * resource_history.LENGTH
+        self.count = 0
+        self.next = 0  # Slot the next sample goes in
+
+    def add(self, when, rss, cpu, threads):
+        i = self.next
+        self.times[i], self.rss[i], self.cpu[i], self.threads[i] = when, rss, cpu, threads
+        self.next = (i + 1) % resource_history.LENGTH
+        self.count = min(self.count + 1, resource_history.LENGTH)
+
+    def span(self):
+        """ Seconds between the oldest and the latest sample """
+        return self.times[self.next - 1] - self.times[self.next if self.count == resource_history.LENGTH else 0]
+
+    def trend(self):
+        """ Least squares fit of RSS over time, (bytes per second, fitted RSS now, r squared) """
+        n = self.count
+        t0 = self.times[self.next - 1]  # Relative to the latest sample, keeps the sums small
+        xs = [self.times[i] - t0 for i in range(n)]
+        ys = [self.rss[i] for i in range(n)]
+        mean_x, mean_y = sum(xs) / n, sum(ys) / n
+        sxx = sum((x - mean_x) ** 2 for x in xs)
+        syy = sum((y - mean_y) ** 2 for y in ys)
+        sxy = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+        if not sxx or not syy:
+            return 0.0, mean_y, 0.0
+        slope = sxy / sxx
+        return slope, mean_y - slope * mean_x, sxy * sxy / (sxx * syy)
+
+
+class resource_sampler(object):
+    """ RSS, CPU time and threads of every server process from /proc/<pid>/stat and statm, in one pass
+
+    Passes are at least SAMPLE_INTERVAL seconds apart. They ride on snapshot refreshes and, once started, on a
+    timer of their own, so the history fills at the same rate however rarely a server is checked. A steady rise
+    in RSS (a fit of at least MIN_FIT over MIN_SAMPLES samples spanning MIN_SPAN) predicts when a server reaches
+    MAX_RSS. The first WARMUP seconds of a process are left out, RSS climbs steadily while a JVM heap warms up.
+    """
+    SAMPLE_INTERVAL = 60
+    MIN_SAMPLES = 10
+    MIN_SPAN = 1800
+    WARMUP = 1800
+    MIN_FIT = 0.8  # r squared
+    MAX_RSS = 0  # Bytes, 0 turns proactive restarts off
+    HORIZON = 6 * 3600  # Predictions further out than this are left alone
+    URGENT = 1800  # Closer than this the restart doesn't wait for a quiet window
+    QUIET_HOURS = (4, 6)  # Local hours [start, end) to restart in when we can't count players
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+    def __init__(self):
+        self.histories = {}  # Server name -> resource_history
+        self.sampled = 0
+
+    def start(self, refresh):
+        """ Samples every SAMPLE_INTERVAL on a thread, refresh rescans the liveness snapshot which samples us """
+        def run():
+            while True:
+                sleep(max(1, self.sampled + resource_sampler.SAMPLE_INTERVAL - time()))
+                if time() - self.sampled < resource_sampler.SAMPLE_INTERVAL:
+                    continue  # A sweep sampled in the meantime
+                try:
+                    refresh(refresh=True)
+                except Exception:
+                    logging.exception("Resource sampling failed")
+
+        worker = threading.Thread(target=run, name="sampler")
+        worker.daemon = True
+        worker.start()
+
+    @staticmethod
+    def read(pid):
+        """ (RSS bytes, CPU seconds, threads) of pid, None if it is gone """
+        try:
+            with open('/proc/{0}/stat'.format(pid), 'rb') as f:
+                stat = f.read()
+            with open('/proc/{0}/statm'.format(pid), 'rb') as f:
+                statm = f.read()
+            fields = stat[stat.rindex(b')') + 2:].split()  # Starts at field 3, the name can contain spaces
+            return (int(statm.split()[1]) * resource_sampler.PAGE_SIZE,
+                    float(int(fields[11]) + int(fields[12])) / resource_sampler.CLOCK_TICKS,
+                    int(fields[17]))
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+
+    def sample(self, snapshot, server_list):
+        """ Samples every listed server's process, unless the last pass was under SAMPLE_INTERVAL ago """
+        now = time()
+        if not snapshot or now - self.sampled < resource_sampler.SAMPLE_INTERVAL:
+            return
+        self.sampled = now
+        for server_name in set(self.histories) - set(server_list):
+            del self.histories[server_name]
+        for server_name in server_list:
+            pid = snapshot.pid(server_name)
+            sample = self.read(pid) if pid else None
+            if not sample:
+                continue
+            history = self.histories.get(server_name)
+            if not history or history.pid != pid:  # A new process starts a new history
+                history = self.histories[server_name] = resource_history(pid, now)
+            if now - history.seen >= resource_sampler.WARMUP:
+                history.add(now, *sample)
+            rss, cpu, threads = sample
+            METRICS.set('mineos_server_rss_bytes', rss, server=server_name)
+            METRICS.set('mineos_server_cpu_seconds', cpu, server=server_name)
+            METRICS.set('mineos_server_threads', threads, server=server_name)
+
+    def memory_eta(self, server_name):
+        """ Seconds until the server is predicted to reach MAX_RSS, None without a trustworthy upward trend """
+        history = self.histories.get(server_name)
+        if not resource_sampler.MAX_RSS or not history or history.count < resource_sampler.MIN_SAMPLES or \
+                history.span() < resource_sampler.MIN_SPAN:
+            return None
+        slope, rss, fit = history.trend()
+        if slope <= 0 or fit < resource_sampler.MIN_FIT:
+            return None
+        eta = max(0, (resource_sampler.MAX_RSS - rss) / slope)
+        METRICS.set('mineos_server_memory_eta_seconds', eta, server=server_name)
+        return eta
+
+    @staticmethod
+    def quiet(players):
+        """ Whether now is a good time to restart: nobody online, or within QUIET_HOURS when we can't tell """
+        if players is not None:
+            return players == 0
+        start, end = resource_sampler.QUIET_HOURS
+        hour = localtime().tm_hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class query_prober(object):
+    """ GS4 (UT3) query for a whole fleet at once over a single non-blocking UDP socket
+
+    Every target gets its own session id, handshakes go out together and each challenge reply
+    is answered with a basic stat request straight away, so a round costs one timeout at most.
+    """
+    MAGIC = b'\xfe\xfd'
+    HANDSHAKE = 9
+    STAT = 0
+    SEND_BATCH = 32  # Packets sent between reads, bursting the whole fleet at once overflows the receive buffer
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+
+    @staticmethod
+    def session_id(index):
+        """ Spreads an index over the low nibbles, the protocol masks session ids with 0x0F0F0F0F """
+        return sum(((index >> (4 * i)) & 0x0F) << (8 * i) for i in range(4))
+
+    @staticmethod
+    def parse_stat(data):
+        fields = data.split(b'\0', 5)
+        return {'motd': fields[0].decode('utf-8', 'replace'),
+                'players': int(fields[3]),
+                'max_players': int(fields[4])}
+
+    def query(self, targets):
+        """ Queries {name: (host, port)}, returns {name: {motd, players, max_players, latency}} for servers that answered """
+        sessions = {}  # Session id -> [name, address, sent at]
+        outbox = deque()
+        for index, (name, (host, port)) in enumerate(targets.items()):
+            try:
+                address = (socket.gethostbyname(host), port)  # Replies are matched against it, so no hostnames
+            except socket.error as e:
+                logging.warning("Can't query server %s at %s: %s", name, host, e)
+                continue
+            session = self.session_id(index + 1)
+            sessions[session] = [name, address, 0]
+            outbox.append((session, address, self.MAGIC + struct.pack('>Bi', self.HANDSHAKE, session)))
+
+        results = {}
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)  # Capped by net.core.rmem_max
+        deadline = time() + self.timeout
+        try:
+            while len(results) < len(sessions) and time() < deadline:
+                readable, writable, _ = select.select([sock], [sock] if outbox else [], [], deadline - time())
+                for _ in range(self.SEND_BATCH if writable else 0):
+                    if not outbox:
+                        break
+                    session, address, packet = outbox[0]
+                    try:
+                        sock.sendto(packet, address)
+                    except socket.error as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            break  # Send buffer full, wait until select says it's writable again
+                        logging.debug("Query to %s failed: %s", address, e)
+                    else:
+                        if packet[2:3] == struct.pack('B', self.HANDSHAKE):
+                            sessions[session][2] = time()
+                    outbox.popleft()
+
+                while readable:
+                    try:
+                        data, address = sock.recvfrom(4096)
+                    except socket.error:
+                        break  # Drained
+                    if len(data) < 5:
+                        continue
+                    kind, session = struct.unpack('>Bi', data[:5])
+                    if session not in sessions or sessions[session][0] in results:
+                        continue
+                    name, target, sent = sessions[session]
+                    if address != target:
+                        continue  # Not from the server we asked, a stray or spoofed reply
+                    if kind == self.HANDSHAKE:
+                        try:
+                            challenge = struct.pack('>i', int(data[5:].split(b'\0')[0]))
+                        except (ValueError, struct.error):
+                            logging.warning("Bad query handshake from %s", name)
+                            continue  # Counts as no reply
+                        outbox.append((session, target, self.MAGIC + struct.pack('>Bi', self.STAT, session) + challenge))
+                    elif kind == self.STAT:
+                        try:
+                            results[name] = self.parse_stat(data[5:])
+                        except (IndexError, ValueError):
+                            logging.warning("Bad query reply from %s", name)
+                            continue
+                        results[name]['latency'] = time() - sent
+        finally:
+            sock.close()
+        return results
+
+
+class rcon_error(Exception):
+    pass
+
+
+class rcon_session(object):
+    """ Authenticated RCON connection that stays open between sweeps and reconnects lazily when it drops """
+    COMMAND = 2
+    AUTH = 3
+    AUTH_RESPONSE = 2
+
+    def __init__(self, host, port, password, timeout=5):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.request_id = 0
+
+    def send(self, kind, body):
+        self.request_id += 1
+        body = body.encode('utf-8') + b'\0\0'
+        self.sock.sendall(struct.pack('<iii', len(body) + 8, self.request_id, kind) + body)
+        return self.request_id
+
+    def receive(self):
+        length, = struct.unpack('<i', slp_probe.recv_exact(self.sock, 4))
+        data = slp_probe.recv_exact(self.sock, length)
+        request_id, kind = struct.unpack('<ii', data[:8])
+        return request_id, kind, data[8:-2].decode('utf-8', 'replace')
+
+    def connect(self):
+        """ Opens and authenticates the session, anything short of that leaves it closed """
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            request_id = self.send(self.AUTH, self.password)
+            while True:
+                response_id, kind, _ = self.receive()
+                if kind == self.AUTH_RESPONSE:
+                    break  # Some servers send an empty response value ahead of the auth response
+        except Exception:
+            self.close()  # Never leave an unauthenticated socket behind for the next call to use
+            raise
+        if response_id == -1 or response_id != request_id:
+            self.close()
+            raise rcon_error("RCON authentication failed for {0}:{1}".format(self.host, self.port))
+        logging.debug("RCON session opened to %s:%s", self.host, self.port)
+
+    def command(self, text):
+        """ Runs a command, returns its output. Any socket error drops the session so the next call reconnects """
+        try:
+            if not self.sock:
+                self.connect()
+            request_id = self.send(self.COMMAND, text)
+            while True:
+                response_id, _, body = self.receive()
+                if response_id == request_id:
+                    return body
+        except (socket.error, ValueError, struct.error):
+            self.close()
+            raise
+
+    def timed_command(self, text):
+        """ Round trip of a command in seconds, not counting a reconnect """
+        if not self.sock:
+            self.connect()
+        start = time()
+        self.command(text)
+        return time() - start
+
+    def close(self):
+        if self.sock:
             try:
+                self.sock.close()
+            except socket.error:
                 pass
-            except RuntimeWarning:
-                print("Please enter a valid server name")
-                break
-            self.sleep()
+        self.sock = None
+
+
+class slp_probe(object):
+    """ Minecraft Server List Ping, proves a server is answering players and not just holding a process
+
+    Does a status handshake followed by a ping/pong, ping() returns (round trip seconds, status dict).
+    A hung JVM usually still accepts the TCP connection, so it shows up as socket.timeout.
+    """
+    PROTOCOL_VERSION = 47  # Servers answer status requests for any protocol version
+
+    def __init__(self, host='127.0.0.1', port=25565, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    @staticmethod
+    def varint(value):
+        out = bytearray()
+        value &= 0xFFFFFFFF
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            out.append(byte | (0x80 if value else 0))
+            if not value:
+                return bytes(out)
+
+    @classmethod
+    def packet(cls, packet_id, payload=b''):
+        body = cls.varint(packet_id) + payload
+        return cls.varint(len(body)) + body
+
+    @staticmethod
+    def recv_exact(sock, length):
+        data = b''
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise ValueError("Connection closed mid packet")
+            data += chunk
+        return data
+
+    @classmethod
+    def read_varint(cls, sock):
+        value = 0
+        for shift in range(0, 35, 7):
+            byte = ord(cls.recv_exact(sock, 1))
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+        raise ValueError("VarInt too long")
+
+    @classmethod
+    def read_packet(cls, sock):
+        data = cls.recv_exact(sock, cls.read_varint(sock))
+        packet_id = ord(data[0:1])  # Status packet ids are single byte varints
+        return packet_id, data[1:]
+
+    def ping(self):
+        host = self.host.encode('utf-8')
+        start = time()
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            sock.sendall(self.packet(0x00, self.varint(self.PROTOCOL_VERSION) + self.varint(len(host)) + host +
+                                     struct.pack('>H', self.port) + self.varint(1)) +  # Handshake, next state status
+                         self.packet(0x00))  # Status request
+            packet_id, data = self.read_packet(sock)
+            if packet_id != 0x00:
+                raise ValueError("Unexpected status packet {0}".format(packet_id))
+            length, offset = 0, 0
+            while True:  # JSON string is prefixed with its VarInt length
+                byte = ord(data[offset:offset + 1])
+                length |= (byte & 0x7F) << (7 * offset)
+                offset += 1
+                if not byte & 0x80:
+                    break
+            status = json.loads(data[offset:offset + length].decode('utf-8'))
+
+            token = struct.pack('>q', int(start * 1000))
+            sock.sendall(self.packet(0x01, token))
+            packet_id, data = self.read_packet(sock)
+            if packet_id != 0x01 or data != token:
+                raise ValueError("Bad pong")
+            return time() - start, status
+        finally:
+            sock.close()
+
+
+class mineos_backend(object):
+    """ Servers managed by MineOS, the interface other backends (simulated_fleet) follow """
+    def list_servers(self, base_directory):
+        return mc.list_servers(base_directory)
+
+    def server(self, server_name, owner, base_directory):
+        """ Handle with an up property and start(), stop() and kill() """
+        return mc(server_name=server_name, owner=owner, base_directory=base_directory)
+
+    def snapshot(self, owner):
+        """ liveness_snapshot for every server at once, or None to fall back to asking each handle """
+        return liveness_snapshot.scan(owner)
+
+
+class simulated_server(object):
+    """ One server of a simulated_fleet, its state is worked out from timestamps so it needs no locking """
+    def __init__(self, fleet, server_name):
+        self.fleet = fleet
+        self.server_name = server_name
+        self.up_at = time()  # Running from here...
+        self.crash_at = self.next_crash(self.up_at)  # ...until here
+        self.stopped = False
+
+    def next_crash(self, up_at):
+        return up_at + random.expovariate(self.fleet.crash_rate) if self.fleet.crash_rate else float('inf')
+
+    def running(self, now):
+        return not self.stopped and self.up_at <= now < self.crash_at
+
+    @property
+    def up(self):
+        if self.fleet.probe_latency:
+            sleep(self.fleet.probe_latency)
+        return self.running(time())
+
+    def start(self):
+        now = time()
+        if self.crash_at <= now and not self.stopped:
+            self.fleet.detections.append(now - self.crash_at)  # How long the crash went unnoticed
+        self.fleet.starts.append(now)
+        self.stopped = False
+        self.up_at = now + self.fleet.boot_time
+        self.crash_at = self.next_crash(self.up_at)
+
+    def stop(self):
+        self.stopped = True
+
+    kill = stop
+
+
+class simulated_fleet(object):
+    """ Stand-in backend with N servers that crash at random, for benchmarks and trying settings without MineOS
+
+    crash_rate is crashes per server per second, boot_time is how long a start takes to come up and
+    probe_latency is added to every individual up check. Snapshots cost nothing unless use_snapshot is off.
+    """
+    def __init__(self, count, crash_rate=0.001, boot_time=5, probe_latency=0.01, use_snapshot=True):
+        self.crash_rate = crash_rate
+        self.boot_time = boot_time
+        self.probe_latency = probe_latency
+        self.use_snapshot = use_snapshot
+        self.detections = deque()  # Seconds from crash to restart
+        self.starts = deque()
+        self.servers = dict(('sim{0:04d}'.format(i), None) for i in range(count))
+        for i in self.servers:
+            self.servers[i] = simulated_server(self, i)
+
+    def list_servers(self, base_directory):
+        return sorted(self.servers)
+
+    def server(self, server_name, owner, base_directory):
+        return self.servers[server_name]
 
+    def snapshot(self, owner):
+        if not self.use_snapshot:
+            return None
+        now = time()
+        snapshot = liveness_snapshot()
+        for i, server in self.servers.items():
+            if server.running(now):
+                snapshot.processes[i] = (None, None)
+        return snapshot
 
-class server_logger(mc):
+
+class server_logger(object):
+    """ Checks and restarts one server through a backend handle (mc for MineOS) """
     USE_GMAIL = False  # Static variable for e-mail mode
+    OUTBOX = None  # alert_outbox once e-mail mode is on
+    DIGEST = None  # alert_digest in front of the outbox when digesting
+    LOG_SLICES = None  # log_slice over LOG_FILENAME, made on first alert
+    USE_SLP = False
+    USE_QUERY = False
+    USE_RCON = False
+    TAIL_LOGS = False
+    PROBE_TIMEOUT = 5
+    LAG_THRESHOLD = 1.0
+    LAG_COMMAND = 'list'  # Cheap, but still has to wait for the main server thread
 
-    def check_server(self):
-        logging.info("Checking server {0}".format(self.server_name))
-        logging.debug("Server {0} is {1}".format(self.server_name,
-                                                 ['Down', 'Up'][self.up]))
+    __slots__ = ('server_name', 'owner', '_base_directory', 'properties_file', 'server', 'restarts', 'sampler')
 
-        if not self.up:
-            self.start_server()
-            try:
-                sleep(BOOT_WAIT)
-            except KeyboardInterrupt:
-                print("Someone is hasty. You should wait for the server to reboot next time.")
-                sys.exit(1)
+    def __init__(self, server_name, owner, base_directory, backend=None):
+        self.server_name = server_name
+        self.owner = owner
+        self._base_directory = base_directory
+        self.properties_file = properties_path(base_directory, server_name)
+        self.server = (backend or mineos_backend()).server(server_name, owner, base_directory)
+        self.restarts = None
+        self.sampler = None
+
+    @property
+    def up(self):
+        return self.server.up
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def kill(self):
+        self.server.kill()
+
+    def check_server(self, status=None, snapshot=None, restarts=None, sampler=None):
+        status = status or server_state(self.server_name)
+        self.restarts = restarts  # Restarts go through the queue when we have one, otherwise happen right away
+        self.sampler = sampler
+        if status.waiting(time()):
+            logging.debug("Server %s is %s, skipping check", self.server_name, status.state)
+            status.schedule(time())
+            return
+
+        logging.info("Checking server %s (every %.0fs)", self.server_name, status.interval,
+                     extra={'server': self.server_name, 'interval': status.interval})
+        start = time()
+        self.run_checks(status, snapshot)
+        status.adapt(healthy=status.state == server_state.UP and not status.hung and not status.laggy and
+                     not status.behind)
+        status.schedule(time())
+        duration = time() - start
+        METRICS.set('mineos_server_up', int(status.state == server_state.UP), server=self.server_name)
+        METRICS.set('mineos_server_check_interval_seconds', status.interval, server=self.server_name)
+        logging.info("Checked server %s in %.3fs, %s", self.server_name, duration, status.state,
+                     extra={'server': self.server_name, 'duration': duration, 'outcome': status.state})
+
+    def run_checks(self, status, snapshot):
+        if server_logger.TAIL_LOGS:
+            self.tail_logs(status)
+        up = snapshot.up(self.server_name) if snapshot else self.up
+        logging.debug("Server %s is %s", self.server_name, ['Down', 'Up'][up])
+
+        if up:
+            if status.state == server_state.QUARANTINED:
+                logging.warning("Server %s is back up, lifting its quarantine", self.server_name)
+                self.restarts.history.clear(self.server_name)
+            status.set(server_state.UP)
+            if status.query_pending:
+                self.query_result(status)
+            if server_logger.USE_SLP:
+                self.probe_server(status)
+            if server_logger.USE_RCON and status.state == server_state.UP:
+                self.rcon_lag(status)
+            if self.sampler and status.state == server_state.UP and not status.stopped_for:
+                self.memory_trend(status)
+        elif status.state == server_state.QUEUED:
+            logging.debug("Server %s is still waiting for a boot slot", self.server_name)
+        elif status.state == server_state.QUARANTINED and \
+                (self.restarts is None or self.restarts.history.is_quarantined(self.server_name)):
+            logging.debug("Server %s is quarantined", self.server_name)
+        elif status.state == server_state.STARTING:
+            logging.warning("Server %s did not come up within %ss, backing off", self.server_name, BOOT_WAIT)
+            status.set(server_state.BACKOFF, deadline=time() + BOOT_WAIT)
+        else:
+            backed_off = status.state == server_state.BACKOFF
+            status.set(server_state.DOWN)
+            crashed = status.crashed and time() - status.crashed[0] < log_tail.REASON_AGE and status.crashed[1]
+            self.restart(status, reason=status.stopped_for or crashed or 'has gone DOWN', backed_off=backed_off,
+                         counted=not status.proactive)
+            status.stopped_for = None
+            status.proactive = False
+            status.crashed = None
+
+    def tail_logs(self, status):
+        """ Reads what the server logged since the last check, crash and lag signatures become events """
+        if status.log is None:
+            status.log = log_tail(self._base_directory, self.server_name)
+        crashes, lags, status.behind = 0, 0, 0
+        try:
+            for line in status.log.lines():
+                if log_tail.CRASH_PATTERN.search(line):
+                    crashes += 1
+                    status.crashed = (time(), 'crashed: ' + line.strip().decode('utf-8', 'replace'))
+                    continue
+                match = log_tail.LAG_PATTERN.search(line)
+                if match:
+                    lags += 1
+                    status.behind = int(match.group(1))
+            for report in status.log.crash_reports():
+                crashes += 1
+                status.crashed = (time(), 'crashed, see crash-reports/' + report)
+        except OSError as e:
+            logging.warning("Can't read the logs of server %s: %s", self.server_name, e)
+        if crashes:
+            logging.error("Server %s %s", self.server_name, status.crashed[1])
+            METRICS.inc('mineos_log_events_total', crashes, server=self.server_name, event='crash')
+        if lags:
+            logging.warning("Server %s can't keep up, %s warnings, last %sms behind", self.server_name, lags,
+                            status.behind)
+            METRICS.inc('mineos_log_events_total', lags, server=self.server_name, event='lag')
 
-    def start_server(self):
-        logging.warning(str(self.server_name) + 'has gone DOWN, restarting.')
-        logging.info("Starting Server: " + self.server_name)
-        logging.debug(str(self._base_directory) + '  ' + str(self.owner))
+    def restart(self, status, reason, backed_off=False, counted=True):
+        """ Queues a restart, unless the server is crash looping and due a backoff or quarantine first
+
+        Uncounted restarts (ones we caused ahead of trouble) skip both and stay out of the restart history.
+        """
+        if self.restarts is not None:
+            now = time()
+            history = self.restarts.history
+            delay = history.backoff(self.server_name, now) if counted else 0
+            if counted and history.quarantine(self.server_name, now):
+                logging.error("Server %s keeps crashing, quarantined until cleared with --clear_quarantine",
+                              self.server_name)
+                self.alert('is quarantined', 'crash looping')
+                status.set(server_state.QUARANTINED)
+            elif delay and not backed_off:
+                logging.warning("Server %s is crash looping, holding its restart for %ss", self.server_name, delay)
+                status.set(server_state.BACKOFF, deadline=now + delay)
+            else:
+                status.set(server_state.QUEUED)
+                self.restarts.request(self.server_name, reason, counted)
+        else:
+            self.start_server(reason=reason)
+            status.set(server_state.STARTING, deadline=time() + BOOT_WAIT)
+
+    def probe_server(self, status):
+        """ Pings a running server, timeouts count towards HUNG_RESTART_AFTER """
+        properties = status.load_properties(self.properties_file)
+        port = properties_port(self.server_name, properties, ['server-port'], 25565)
+        if port is None:
+            return
+        probe = slp_probe(host=properties.get('server-ip') or '127.0.0.1',
+                          port=port,
+                          timeout=server_logger.PROBE_TIMEOUT)
+        try:
+            status.latency, _ = probe.ping()
+            METRICS.observe('mineos_probe_latency_seconds', status.latency, server=self.server_name, probe='slp')
+            status.hung = 0
+            logging.debug("Server %s answered ping in %.3fs", self.server_name, status.latency)
+        except socket.timeout:
+            self.probe_timed_out(status, 'ping')
+        except (socket.error, ValueError) as e:  # Refused etc. is usually a server still loading its world
+            logging.warning("Server %s ping failed: %s", self.server_name, e)
+
+    def query_result(self, status):
+        """ Consumes the latest query round, no reply counts the same as a ping timeout """
+        status.query_pending = False
+        if status.query is None:
+            self.probe_timed_out(status, 'query')
+            return
+        status.hung = 0
+        status.latency = status.query['latency']
+        METRICS.observe('mineos_probe_latency_seconds', status.latency, server=self.server_name, probe='query')
+        logging.debug("Server %s has %s/%s players, query took %.3fs",
+                      self.server_name, status.query['players'], status.query['max_players'], status.latency)
+
+    def rcon_lag(self, status):
+        """ Times a command over the server's persistent RCON session, a run of slow ones stops the server """
+        properties = status.load_properties(self.properties_file)
+        if properties.get('enable-rcon') != 'true':
+            return
+        host = properties.get('server-ip') or '127.0.0.1'
+        port = properties_port(self.server_name, properties, ['rcon.port'], 25575)
+        if port is None:
+            return
+        password = properties.get('rcon.password', '')
+        if not status.rcon or (status.rcon.host, status.rcon.port, status.rcon.password) != (host, port, password):
+            if status.rcon:
+                status.rcon.close()
+            status.rcon = rcon_session(host=host, port=port, password=password, timeout=server_logger.PROBE_TIMEOUT)
+
+        try:
+            status.lag = status.rcon.timed_command(server_logger.LAG_COMMAND)
+            METRICS.observe('mineos_probe_latency_seconds', status.lag, server=self.server_name, probe='rcon')
+        except socket.timeout:
+            self.probe_timed_out(status, 'RCON command')
+            return
+        except (socket.error, ValueError, struct.error, rcon_error) as e:
+            logging.warning("Server %s RCON failed: %s", self.server_name, e)
+            return
+
+        logging.debug("Server %s RCON round trip %.3fs", self.server_name, status.lag)
+        if status.lag < server_logger.LAG_THRESHOLD:
+            status.laggy = 0
+            return
+        status.laggy += 1
+        logging.warning("Server %s is lagging, RCON took %.3fs (%s/%s)",
+                        self.server_name, status.lag, status.laggy, LAG_RESTART_AFTER)
+        if status.laggy >= LAG_RESTART_AFTER:
+            status.laggy = 0
+            status.rcon.close()
+            status.stopped_for = 'was lagging'
+            self.stop()  # Graceful so the world gets saved, the next check sees it down and starts it again
+
+    def memory_trend(self, status):
+        """ Gracefully restarts a server heading for its memory ceiling, in a quiet moment when there is time """
+        eta = self.sampler.memory_eta(self.server_name)
+        if eta is None or eta > resource_sampler.HORIZON:
+            return
+        players = status.query.get('players') if status.query else None
+        if eta > resource_sampler.URGENT and not resource_sampler.quiet(players):
+            logging.info("Server %s is predicted to reach %.0fMB in %.1fh, waiting for a quiet moment to restart it",
+                         self.server_name, resource_sampler.MAX_RSS / 1024 / 1024, eta / 3600)
+            return
+        logging.warning("Server %s is predicted to reach %.0fMB in %.0f minutes, restarting it ahead of time",
+                        self.server_name, resource_sampler.MAX_RSS / 1024 / 1024, eta / 60)
+        if status.rcon:
+            status.rcon.close()
+        status.stopped_for = 'was running out of memory'
+        status.proactive = True
+        self.stop()  # Graceful so the world gets saved, the next check sees it down and starts it again
+
+    def probe_timed_out(self, status, probe):
+        status.hung += 1
+        logging.warning("Server %s %s timed out (%s/%s)", self.server_name, probe, status.hung, HUNG_RESTART_AFTER)
+        if status.hung >= HUNG_RESTART_AFTER:
+            status.hung = 0
+            if status.rcon:
+                status.rcon.close()
+            self.kill()
+            self.restart(status, reason='has stopped responding')
+
+    def start_server(self, reason='has gone DOWN'):
+        logging.warning("%s %s, restarting.", self.server_name, reason)
+        logging.info("Starting Server: %s", self.server_name)
+        logging.debug("%s  %s", self._base_directory, self.owner)
 
         self.start()
-        if server_logger.USE_GMAIL:
+        METRICS.inc('mineos_restarts_total', server=self.server_name)
+        self.alert('is down', reason)
+
+    def alert(self, event, reason):
+        """ Mails the event with our log attached, through the digest and outbox when they are set up """
+        if not server_logger.USE_GMAIL:
+            return
+        if not server_logger.LOG_SLICES:
+            server_logger.LOG_SLICES = log_slice(LOG_FILENAME)
+        for handler in logging.getLogger().handlers:
+            handler.flush()  # So the slice has the lines logged just before this alert
+        try:
+            log = server_logger.LOG_SLICES.read(self.server_name)
+        except IOError:
+            logging.error("Can't find the log file to send, aborting sending mail")
+            return
+        if server_logger.DIGEST:
+            server_logger.DIGEST.add(self.server_name, event, reason, log)
+            return
+        subject = "Server " + self.server_name + " " + event
+        if server_logger.OUTBOX:
+            server_logger.OUTBOX.put(subject=subject, text=log)  # Delivered in the background
+        else:
+            gmail().send(subject=subject, text=log)  # Create gmail obj
+
+
+class queue_log_handler(logging.Handler):
+    """ Hands records to a writer thread, so the monitor never waits on the disk to log
+
+    Records keep their arguments, so messages are still only formatted by the writer when they are written.
+    """
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.records = Queue.Queue()
+        self.writer = threading.Thread(target=self.write, name="log-writer")
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)  # Traceback won't survive the hop
+            record.exc_info = None
+        self.records.put(record)
+
+    def write(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            if not isinstance(record, logging.LogRecord):  # flush() waiting on everything before it
+                self.target.flush()
+                record.set()
+                continue
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def flush(self, timeout=5):
+        """ Waits until every record queued so far has been written """
+        if self.writer.is_alive():
+            written = threading.Event()
+            self.records.put(written)
+            written.wait(timeout)
+
+    def close(self):
+        """ Flushes whatever is still queued """
+        if self.writer.is_alive():
+            self.records.put(None)
+            self.writer.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class json_log_formatter(logging.Formatter):
+    """ One JSON object per record, with the server/duration/outcome fields checks pass in extra """
+    FIELDS = ('server', 'duration', 'outcome', 'interval')
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'message': record.getMessage(),
+                 'file': record.filename,
+                 'line': record.lineno,
+                 'thread': record.threadName}
+        for i in self.FIELDS:
+            if hasattr(record, i):
+                entry[i] = getattr(record, i)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)  # Cached on the record, like Formatter does
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
+
+class rotating_log_handler(logging.handlers.RotatingFileHandler):
+    """ Rotates the log by size or age, rotated files are gzipped and pruned by a background thread
+
+    Rotated files are renamed to <log>.<timestamp> and then <log>.<timestamp>.gz. Every rotation bumps
+    GENERATION and ROTATED maps old generations to their file, so log_slice can finish reading a file
+    after it moved. Inodes aren't used for this as a pruned file's inode is soon reused.
+    """
+    GENERATION = 0
+    ROTATED = {}  # Generation -> rotated path, without the .gz
+    FIRST_RECORD = re.compile(br'^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)|"time": ([\d.]+)')  # LOG_FORMAT or JSON
+
+    def __init__(self, filename, max_bytes, max_age, backups):
+        logging.handlers.RotatingFileHandler.__init__(self, filename, maxBytes=max_bytes)
+        self.max_age = max_age
+        self.backups = backups
+        self.opened_at = self.started_at()
+        self.compress_queue = Queue.Queue()
+        worker = threading.Thread(target=self.compressor, name="log-compressor")
+        worker.daemon = True
+        worker.start()
+
+    def started_at(self):
+        """ When the current log was begun, so age survives monitor restarts: the newest rotation, else its first
+        record, else now. mtime and ctime are no use, every write updates them.
+        """
+        directory, name = os.path.split(self.baseFilename)
+        started = []
+        for i in os.listdir(directory or '.'):
+            if i.startswith(name + '.'):
+                try:
+                    started.append(mktime(strptime(i[len(name) + 1:len(name) + 16], '%Y%m%d-%H%M%S')))
+                except ValueError:
+                    continue
+        if started:
+            return max(started)
+        try:
+            with open(self.baseFilename, 'rb') as f:
+                match = self.FIRST_RECORD.match(f.readline())
+            if match and match.group(1):
+                return mktime(strptime(match.group(1).decode('ascii'), '%Y-%m-%d %H:%M:%S'))
+            if match:
+                return float(match.group(2))
+        except (IOError, ValueError):
+            pass
+        return time()
+
+    def shouldRollover(self, record):
+        if self.max_age and time() - self.opened_at >= self.max_age:
+            return 1
+        return logging.handlers.RotatingFileHandler.shouldRollover(self, record)
+
+    def doRollover(self):
+        """ Only renames on the logging path, compression happens on the compressor thread """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        now = time()
+        rotated = "{0}.{1}.{2:06d}".format(self.baseFilename, strftime('%Y%m%d-%H%M%S', localtime(now)),
+                                           int(now * 1000000) % 1000000)
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, rotated)
+            rotating_log_handler.ROTATED[rotating_log_handler.GENERATION] = rotated
+            self.compress_queue.put(rotated)
+        rotating_log_handler.GENERATION += 1
+        self.stream = self._open()
+        self.opened_at = now
+
+    def compressor(self):
+        while True:
+            rotated = self.compress_queue.get()
+            try:
+                with open(rotated, 'rb') as source:
+                    with gzip.open(rotated + '.gz.tmp', 'wb') as target:
+                        while True:
+                            chunk = source.read(1024 * 1024)
+                            if not chunk:
+                                break
+                            target.write(chunk)
+                os.rename(rotated + '.gz.tmp', rotated + '.gz')
+                os.remove(rotated)
+                self.prune()
+            except (IOError, OSError) as e:
+                sys.stderr.write("Can't compress {0}: {1}\n".format(rotated, e))  # Logging from here could recurse
+
+    def prune(self):
+        directory, name = os.path.split(self.baseFilename)
+        rotated = sorted(i for i in os.listdir(directory) if i.startswith(name + '.') and i.endswith('.gz'))
+        for i in rotated[:max(0, len(rotated) - self.backups)]:
+            os.remove(os.path.join(directory, i))
+        for generation, path in list(rotating_log_handler.ROTATED.items()):
+            if not os.path.exists(path) and not os.path.exists(path + '.gz'):
+                del rotating_log_handler.ROTATED[generation]
+
+
+class log_slice(object):
+    """ Hands out the part of the log written since a server's previous alert, or its last few lines
+
+    Never reads more than MAX_BYTES, so cost doesn't grow with the log. If the log was rotated since
+    the last alert the rest of the rotated file, compressed or not, is read first, again no more than
+    its last MAX_BYTES (a compressed file still has to be decompressed up to there, but isn't kept).
+    """
+    MAX_BYTES = 64 * 1024
+    TAIL_LINES = 50  # For a server's first alert
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}  # Server name -> (log generation, log size) at its last alert
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def rotated_size(name, compressed):
+        """ Uncompressed size, for a gzip file from its trailer (modulo 4GB, far beyond any --log_max_mb) """
+        with open(name, 'rb') as f:
+            if not compressed:
+                return os.fstat(f.fileno()).st_size
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+
+    def read_rotated(self, generation, offset):
+        path = rotating_log_handler.ROTATED.get(generation)
+        for opener, name in [(open, path), (gzip.open, "{0}.gz".format(path))]:
+            try:
+                start = max(offset, self.rotated_size(name, opener is gzip.open) - self.MAX_BYTES)
+                with opener(name, 'rb') as f:
+                    f.seek(start)
+                    data = f.read(self.MAX_BYTES)
+                if start > offset:
+                    data = data.split(b'\n', 1)[-1]  # Seeked into the middle of a line
+                return data
+            except (IOError, OSError, TypeError, struct.error):  # Moved on to .gz, pruned, or we never knew the name
+                continue
+        return b''
+
+    def read(self, server_name):
+        with self.lock:
+            previous = self.offsets.get(server_name)
+            first_alert = False
+            with open(self.path, 'rb') as f:
+                generation = rotating_log_handler.GENERATION
+                f.seek(0, os.SEEK_END)
+                end = f.tell()
+                data = b''
+                if previous and previous[0] != generation:
+                    data = self.read_rotated(*previous)  # Finish the file we left off in
+                    start = 0
+                elif previous and previous[1] <= end:
+                    start = previous[1]
+                else:  # First alert, or a shrunken file that was truncated
+                    first_alert = True
+                    start = 0
+                start = max(start, end - self.MAX_BYTES)
+                f.seek(start)
+                data += f.read(end - start)
+            self.offsets[server_name] = (generation, end)
+
+        trimmed = len(data) > self.MAX_BYTES or (start and start == end - self.MAX_BYTES)
+        data = data[-self.MAX_BYTES:]
+        lines = data.splitlines(True)
+        if trimmed:
+            lines = lines[1:]  # Seeked into the middle of a line
+        if first_alert:
+            lines = lines[-self.TAIL_LINES:]
+        return b''.join(lines).decode('utf-8', 'replace')
+
+
+class alert_digest(object):
+    """ Collects alerts over a window and hands the outbox a single mail for all of them
+
+    Repeats of the same server and event within a window are counted rather than listed again, and
+    no more than max_per_hour digests go out, anything over that rolls into the next one.
+    Pending alerts are kept in the outbox's spool directory as PENDING_FILENAME until the digest is
+    handed over, so a crash or Ctrl-C loses nothing and the next start sends them.
+    """
+    PENDING_FILENAME = "digest.pending"  # Not .json, the outbox worker leaves it alone
+
+    def __init__(self, outbox, window=60, max_per_hour=12):
+        self.outbox = outbox
+        self.window = window
+        self.max_per_hour = max_per_hour
+        self.events = {}  # (server, event, reason) -> [first seen, last seen, count]
+        self.logs = {}  # Server -> log slices in order, each alert's slice picks up where the last one ended
+        self.sent = deque()  # When recent digests went out, for the hourly cap
+        self.timer = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """ Picks up what a previous run left pending and schedules it """
+        try:
+            with open(os.path.join(self.outbox.directory, self.PENDING_FILENAME)) as fh:
+                pending = json.loads(fh.read())
+        except IOError:
+            return
+        except ValueError:
+            logging.error("Pending alert digest is unreadable, dropping it")
+            return
+        with self.lock:
+            self.events = dict(((server, event, reason), [first, last, count])
+                               for server, event, reason, first, last, count in pending['events'])
+            self.logs = pending['logs']
+            self.sent = deque(pending['sent'])
+            if self.events:
+                logging.info("Picked up %s pending alerts from the last run", len(self.events))
+                self.schedule(self.window)
+
+    def save(self):
+        """ Caller holds the lock """
+        path = os.path.join(self.outbox.directory, self.PENDING_FILENAME)
+        try:
+            if not self.events:
+                if os.path.exists(path):
+                    os.remove(path)
+                return
+            self.outbox.write(self.PENDING_FILENAME, {
+                'events': [list(key) + value for key, value in self.events.items()],
+                'logs': self.logs,
+                'sent': list(self.sent)})
+        except (IOError, OSError) as e:
+            logging.error("Can't save pending alerts: %s", e)
+
+    def add(self, server_name, event, reason, log):
+        with self.lock:
+            now = time()
+            key = (server_name, event, reason)
+            if key in self.events:
+                self.events[key][1] = now
+                self.events[key][2] += 1
+            else:
+                self.events[key] = [now, now, 1]
+            if log:
+                self.logs.setdefault(server_name, []).append(log)
+            self.save()
+            if not self.timer:
+                self.schedule(self.window)
+
+    def schedule(self, delay):
+        """ Caller holds the lock """
+        self.timer = threading.Timer(delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if not self.events:
+                return
+            now = time()
+            while self.sent and now - self.sent[0] > 3600:
+                self.sent.popleft()
+            if len(self.sent) >= self.max_per_hour:
+                logging.warning("Hourly alert limit reached, holding %s alerts", len(self.events))
+                self.schedule(3600 - (now - self.sent[0]))
+                return
+            events = dict((key, list(value)) for key, value in self.events.items())
+            logs = dict((server, list(slices)) for server, slices in self.logs.items())
+            self.sent.append(now)
+
+        servers = sorted(set(server for server, _, _ in events))
+        lines = []
+        for (server, event, reason), (first, last, count) in sorted(events.items(), key=lambda i: i[1][0]):
+            lines.append("{0} {1} ({2}) x{3}, {4} - {5}".format(server, event, reason, count,
+                                                                 strftime('%H:%M:%S', localtime(first)),
+                                                                 strftime('%H:%M:%S', localtime(last))))
+        text = "\n".join(lines)
+        for server in servers:
+            text += "\n\n--- {0} ---\n{1}".format(server, ''.join(logs.get(server, [])))
+        subject = "Server {0} {1}".format(servers[0], events.keys()[0][1]) if len(events) == 1 else \
+            "{0} alerts from {1} servers".format(sum(i[2] for i in events.values()), len(servers))
+        self.outbox.put(subject=subject, text=text)
+        with self.lock:  # Only once the outbox has it, alerts that came in meanwhile stay pending
+            for key, (_, last, count) in events.items():
+                pending = self.events[key]
+                if pending[2] > count:
+                    self.events[key] = [last, pending[1], pending[2] - count]
+                else:
+                    del self.events[key]
+            for server, slices in logs.items():
+                del self.logs.get(server, [])[:len(slices)]
+                if not self.logs.get(server, True):
+                    del self.logs[server]
+            self.save()
+
+
+class alert_outbox(object):
+    """ Alerts spooled to disk and mailed by a background thread, so checks never wait on SMTP
+
+    Every alert is its own JSON file, written to a temp name and renamed into place, so a crash
+    can't leave a half written alert and anything undelivered is sent on the next start.
+    Failed deliveries are retried with exponential backoff.
+    """
+    SPOOL_DIRECTORY = "outbox"
+    RETRY_BASE = 30
+    RETRY_CAP = 3600
+
+    def __init__(self, send, directory=SPOOL_DIRECTORY):
+        self.send = send  # send(subject, text), raises on failure
+        self.directory = directory
+        self.wake = threading.Event()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.depth = 0
+        self.depth_lock = threading.Lock()  # Puts come from check and timer threads, dequeues from the worker
+        self.queued(len(self.spooled()))
+
+    def queued(self, count=1):
+        with self.depth_lock:
+            self.depth += count
+            METRICS.set('mineos_alert_queue_depth', self.depth)
+
+    def dequeued(self):
+        self.queued(-1)
+
+    def __len__(self):
+        return len(self.spooled())
+
+    def spooled(self):
+        return sorted(i for i in os.listdir(self.directory) if i.endswith('.json'))
+
+    def write(self, name, alert):
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'w') as fh:
+            fh.write(json.dumps(alert))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(path + '.tmp', path)
+
+    def put(self, subject, text):
+        now = time()
+        name = "{0:017.6f}-{1}.json".format(now, uuid.uuid4().hex)  # Sorts oldest first
+        self.write(name, {'subject': subject, 'text': text, 'created': now, 'attempts': 0, 'next_attempt': now})
+        self.queued()
+        self.wake.set()
+
+    def deliver(self):
+        """ Tries every alert that is due, returns when the next retry is due """
+        next_due = None
+        for name in self.spooled():
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as fh:
+                    alert = json.loads(fh.read())
+            except (IOError, ValueError):
+                logging.error("Spooled alert %s is unreadable, setting it aside", name)
+                os.rename(path, path + '.bad')
+                self.dequeued()
+                continue
+
+            if alert['next_attempt'] > time():
+                next_due = min(next_due or alert['next_attempt'], alert['next_attempt'])
+                continue
+            try:
+                self.send(alert['subject'], alert['text'])
+                os.remove(path)
+                self.dequeued()
+            except (smtplib.SMTPException, socket.error) as e:
+                alert['attempts'] += 1
+                alert['next_attempt'] = time() + min(self.RETRY_CAP, self.RETRY_BASE * 2 ** (alert['attempts'] - 1))
+                logging.warning("Alert delivery failed (%s), attempt %s, retrying in %.0fs",
+                                e, alert['attempts'], alert['next_attempt'] - time())
+                self.write(name, alert)
+                next_due = min(next_due or alert['next_attempt'], alert['next_attempt'])
+        return next_due
+
+    def run(self):
+        while True:
+            self.wake.clear()
             try:
-                with open(LOG_FILENAME) as f:
-                    log = f.read()
-                    gmail().send(subject="Server " + self.server_name + " is down", text=log)  # Create gmail obj
+                next_due = self.deliver()
+            except Exception:  # Keep the worker alive whatever happens, the spool is still on disk
+                logging.exception("Alert outbox worker error")
+                next_due = time() + self.RETRY_BASE
+            self.wake.wait(None if next_due is None else max(0, next_due - time()))
 
-            except IOError:
-                logging.error("Can't find the log file to send, aborting sending mail")
+    def start(self):
+        worker = threading.Thread(target=self.run, name="alert-outbox")
+        worker.daemon = True
+        worker.start()
+        return self
 
 
 class gmailSettings():
@@ -261,20 +2805,107 @@ class SettingsHelper(gmailSettings):
         logging.debug("Settings Saved")
 
 
+class smtp_session(object):
+    """ One authenticated SMTP connection shared by every alert
+
+    Idle connections are checked with NOOP before use, anything that looks like a dropped
+    connection closes it and the message is retried once over a fresh handshake.
+    """
+    KEEPALIVE = 60  # Seconds idle before a NOOP checks the connection is still there
+
+    def __init__(self, host, port, username, password, starttls=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.server = None
+        self.last_used = 0
+        self.lock = threading.Lock()  # Alerts go out from several check threads
+
+    def connect(self):
+        """ Opens and authenticates a connection, returns how long the handshake took """
+        self.close()
+        start = time()
+        self.server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        self.server.ehlo()
+        if self.starttls:
+            self.server.starttls()
+            self.server.ehlo()
+        if self.username:
+            self.server.login(self.username, self.password)
+        self.last_used = time()
+        logging.debug("SMTP session opened to %s:%s", self.host, self.port)
+        return time() - start
+
+    def alive(self):
+        if not self.server:
+            return False
+        if time() - self.last_used < self.KEEPALIVE:
+            return True
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def sendmail(self, from_address, to_addresses, message):
+        """ Sends over the shared connection, returns (handshake seconds, send seconds) """
+        with self.lock:
+            for attempt in range(2):
+                handshake = 0
+                try:
+                    if not self.alive():
+                        handshake = self.connect()
+                    start = time()
+                    self.server.sendmail(from_address, to_addresses, message)
+                    self.last_used = time()
+                    return handshake, self.last_used - start
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, socket.error):
+                    self.close()
+                    if attempt:
+                        raise
+                    logging.info("SMTP connection dropped, reconnecting")
+
+    def close(self):
+        if self.server:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+        self.server = None
+
+
 class gmail(object, SettingsHelper):
     """ Lets users send email messages """
     # TODO Maybe implement other mail providers
+    SMTP_HOST = "smtp.gmail.com"
+    SMTP_PORT = 587  # or port 465 doesn't seem to work!
+    SMTP_STARTTLS = True
+    SESSION = None  # smtp_session shared by every gmail object
+    SESSION_LOCK = threading.Lock()
+
     def __init__(self):
         self.loadSettings()
         self.PASSWORD = keyring.get_password(self.KEYRING_APP_ID, self.USERNAME)  # Loads password from secure storage
 
+    def session(self):
+        """ The shared SMTP session, replaced if the settings it was opened with have changed """
+        with gmail.SESSION_LOCK:
+            current = gmail.SESSION
+            if not current or (current.host, current.port, current.username, current.password) != \
+                    (self.SMTP_HOST, self.SMTP_PORT, self.USERNAME, self.PASSWORD):
+                if current:
+                    current.close()
+                gmail.SESSION = smtp_session(self.SMTP_HOST, self.SMTP_PORT, self.USERNAME, self.PASSWORD,
+                                             starttls=self.SMTP_STARTTLS)
+            return gmail.SESSION
+
     def test_login(self):
+        session = self.session()
         try:
-            server = smtplib.SMTP("smtp.gmail.com", 587)  # or port 465 doesn't seem to work!
-            server.ehlo()
-            server.starttls()
-            server.login(self.USERNAME, self.PASSWORD)
-            server.close()
+            with session.lock:
+                session.connect()  # Left open for the first alert
         except smtplib.SMTPAuthenticationError:
             print("Username password mismatch")
             sys.exit(1)
@@ -286,13 +2917,11 @@ class gmail(object, SettingsHelper):
                                                                     text)
 
         logging.info("Sending email")
-        server = smtplib.SMTP("smtp.gmail.com", 587)  # or port 465 doesn't seem to work!
-        server.ehlo()
-        server.starttls()
-        server.login(self.USERNAME, self.PASSWORD)
-        server.sendmail(self.USERNAME, self.SEND_ALERT_TO, message)
-        server.close()
-        logging.info("Message Sent")
+        handshake, send = self.session().sendmail(self.USERNAME, self.SEND_ALERT_TO, message)
+        if handshake:
+            METRICS.observe('mineos_smtp_seconds', handshake, phase='handshake')
+        METRICS.observe('mineos_smtp_seconds', send, phase='send')
+        logging.info("Message Sent (handshake %.3fs, send %.3fs)", handshake, send)
 
     def configure(self):
         print("Enter user email (user@domain.com) or press enter to skip")